@@ -0,0 +1,195 @@
+import math
+
+import numpy as np
+import pymongo
+from pymongo.synchronous.collection import Collection
+
+# Споживання вважається стрибком, якщо перевищує середнє на стільки стандартних відхилень
+SPIKE_SIGMAS = 4.0
+# Скільки звичайних ненульових показів лічильника потрібно, перш ніж профілю можна довіряти
+MIN_SAMPLES = 5
+# Найменше перевищення середнього, що вважається стрибком, щоб майже нульове споживання не робило стрибком будь-яке
+SPIKE_MIN_USAGE = 5.0
+# Скільки стрибків поспіль вважаються зміною споживання, а не помилкою, після чого профіль будується заново
+REBASELINE_SPIKES = 3
+
+ROLLBACK = "rollback"
+SPIKE = "spike"
+
+
+class RunningStats:
+    """Середнє та дисперсія споживання між показами, що оновлюються за Велфордом без зберігання історії."""
+
+    __slots__ = ("count", "mean", "m2", "spikes", "nonzero")
+
+    def __init__(self, count: int = 0, mean: float = 0.0, m2: float = 0.0, spikes: list[float] | None = None,
+                 nonzero: int | None = None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        # Кількість ненульових значень; профілі, збережені без неї, вважаються ненульовими, якщо середнє додатне
+        self.nonzero = nonzero if nonzero is not None else (count if mean > 0 else 0)
+        # Стрибки поспіль, що ще не потрапили в статистику
+        self.spikes = spikes or []
+
+    def update(self, value: float):
+        self.count += 1
+        if value > 0:
+            self.nonzero += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def spike_threshold(self) -> float | None:
+        """Найбільше правдоподібне споживання або None, поки статистики замало."""
+        # Нульове споживання нічого не каже про звичайне, тож таким профілям поки не довіряємо
+        if self.nonzero < MIN_SAMPLES:
+            return None
+        # Для рівномірного споживання std близьке до нуля, тож стрибком вважається щонайменше подвоєне середнє
+        return self.mean + max(SPIKE_SIGMAS * self.std, self.mean, SPIKE_MIN_USAGE)
+
+    def observe(self, usage: float, default: float) -> tuple[float, str | None]:
+        """Перевіряє споживання через check_usage і враховує його в статистиці.
+
+        Звичайне споживання оновлює статистику, а стрибки відкладаються. Після REBASELINE_SPIKES стрибків
+        поспіль статистика будується заново з них, і останній стрибок нараховується як є.
+        """
+        billed, kind = check_usage(self, usage, default)
+        if kind is None:
+            self.update(usage)
+            self.spikes.clear()
+        elif kind == SPIKE:
+            self.spikes.append(usage)
+            if len(self.spikes) >= REBASELINE_SPIKES:
+                spikes, self.spikes = self.spikes, []
+                self.count, self.mean, self.m2, self.nonzero = 0, 0.0, 0.0, 0
+                for value in spikes:
+                    self.update(value)
+                return usage, None
+        return billed, kind
+
+    def as_dict(self) -> dict:
+        return {"count": self.count, "mean": self.mean, "m2": self.m2, "spikes": self.spikes, "nonzero": self.nonzero}
+
+
+class MeterProfile:
+    """Профіль споживання лічильника окремо для денної та нічної зони."""
+
+    def __init__(self, meter_id: int, day: RunningStats | None = None, night: RunningStats | None = None):
+        self.meter_id = meter_id
+        self.day = day or RunningStats()
+        self.night = night or RunningStats()
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> "MeterProfile":
+        return cls(doc["meter_id"], RunningStats(**doc["day"]), RunningStats(**doc["night"]))
+
+    def as_doc(self) -> dict:
+        return {"meter_id": self.meter_id, "day": self.day.as_dict(), "night": self.night.as_dict()}
+
+    def update(self, day_usage: float, night_usage: float):
+        self.day.update(day_usage)
+        self.night.update(night_usage)
+
+    def observe(self, day_usage: float, night_usage: float, day_default: float, night_default: float):
+        """Споживання для нарахування та види аномалій для денної й нічної зони."""
+        return self.day.observe(day_usage, day_default), self.night.observe(night_usage, night_default)
+
+
+def check_usage(stats: RunningStats, usage: float, default: float) -> tuple[float, str | None]:
+    """Споживання для нарахування та вид аномалії.
+
+    Аномальне споживання замінюється типовим для лічильника, а до накопичення статистики — default.
+    """
+    if usage < 0:
+        kind = ROLLBACK
+    else:
+        threshold = stats.spike_threshold()
+        if threshold is None or usage <= threshold:
+            return usage, None
+        kind = SPIKE
+    return (stats.mean if stats.nonzero >= MIN_SAMPLES else default), kind
+
+
+def _group_stats(groups: np.ndarray, values: np.ndarray, mask: np.ndarray, size: int):
+    counts = np.bincount(groups[mask], minlength=size)
+    sums = np.bincount(groups[mask], weights=values[mask], minlength=size)
+    means = np.divide(sums, counts, out=np.zeros(size), where=counts > 0)
+    m2 = np.bincount(groups[mask], weights=(values[mask] - means[groups[mask]]) ** 2, minlength=size)
+    nonzero = np.bincount(groups[mask & (values > 0)], minlength=size)
+    return counts, means, m2, nonzero
+
+
+def _spikes(groups: np.ndarray, values: np.ndarray, mask: np.ndarray, size: int) -> np.ndarray:
+    """Порівнює кожне споживання зі статистикою решти показів того ж лічильника.
+
+    Статистика всієї історії включала б і сам стрибок, який тоді ховався б у завищеній дисперсії.
+    """
+    counts = np.bincount(groups[mask], minlength=size)[groups] - 1
+    nonzero = np.bincount(groups[mask & (values > 0)], minlength=size)[groups] - (values > 0)
+    sums = np.bincount(groups[mask], weights=values[mask], minlength=size)[groups] - values
+    squares = np.bincount(groups[mask], weights=values[mask] ** 2, minlength=size)[groups] - values ** 2
+    means = np.divide(sums, counts, out=np.zeros(len(values)), where=counts > 0)
+    variances = np.divide(squares - counts * means ** 2, counts - 1, out=np.zeros(len(values)), where=counts > 1)
+    threshold = means + np.maximum.reduce([SPIKE_SIGMAS * np.sqrt(np.maximum(variances, 0)), means,
+                                           np.full(len(values), SPIKE_MIN_USAGE)])
+    return mask & (nonzero >= MIN_SAMPLES) & (values > threshold)
+
+
+def score_usage(meter_ids: np.ndarray, day: np.ndarray, night: np.ndarray) -> dict:
+    """Векторна перевірка всієї історії показів.
+
+    Масиви впорядковані за лічильником, а в межах лічильника — за часом. Відкати шукаються так само,
+    як у потоковій перевірці, а стрибки — відносно решти історії лічильника, а не лише попередніх показів.
+    Профіль рахується з показів без аномалій.
+    """
+    same_meter = meter_ids[1:] == meter_ids[:-1]
+    rows = np.flatnonzero(same_meter) + 1
+    meters, groups = np.unique(meter_ids[rows], return_inverse=True)
+    size = len(meters)
+    usage = {"day": (day[1:] - day[:-1])[same_meter], "night": (night[1:] - night[:-1])[same_meter]}
+
+    rollback = (usage["day"] < 0) | (usage["night"] < 0)
+    spike = _spikes(groups, usage["day"], ~rollback, size) | _spikes(groups, usage["night"], ~rollback, size)
+
+    regular = ~rollback & ~spike
+    stats = {zone: [RunningStats(int(count), float(mean), float(m2), nonzero=int(nonzero))
+                    for count, mean, m2, nonzero in zip(*_group_stats(groups, values, regular, size))]
+             for zone, values in usage.items()}
+
+    return {
+        "rows": rows,
+        "kinds": np.where(rollback, ROLLBACK, np.where(spike, SPIKE, "")),
+        "day_usage": usage["day"],
+        "night_usage": usage["night"],
+        "profiles": [MeterProfile(meter_id, stats["day"][i], stats["night"][i])
+                     for i, meter_id in enumerate(meters.tolist())],
+    }
+
+
+def scan_history(meters_data: Collection) -> tuple[list[dict], list[MeterProfile], int]:
+    """Аномальні покази, профілі лічильників та кількість перевірених показів."""
+    ids, date_times, meter_ids, day, night = [], [], [], [], []
+    # Зворотний порядок індексу (meter_id, date_time, _id): лічильники йдуть підряд, покази — від старих
+    cursor = meters_data.find({}, {"meter_id": 1, "day": 1, "night": 1, "date_time": 1},
+                              sort=[("meter_id", pymongo.DESCENDING), ("date_time", pymongo.ASCENDING),
+                                    ("_id", pymongo.ASCENDING)])
+    for doc in cursor:
+        ids.append(doc["_id"])
+        date_times.append(doc["date_time"])
+        meter_ids.append(doc["meter_id"])
+        day.append(doc["day"])
+        night.append(doc["night"])
+    if not ids:
+        return [], [], 0
+
+    scores = score_usage(np.array(meter_ids), np.array(day, dtype=float), np.array(night, dtype=float))
+    anomalies = [{"_id": ids[row], "meter_id": meter_ids[row], "date_time": date_times[row], "kind": str(kind),
+                  "day_usage": float(day_usage), "night_usage": float(night_usage)}
+                 for row, kind, day_usage, night_usage in zip(scores["rows"].tolist(), scores["kinds"],
+                                                               scores["day_usage"], scores["night_usage"]) if kind]
+    return anomalies, scores["profiles"], len(ids)
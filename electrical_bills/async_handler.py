@@ -0,0 +1,221 @@
+import asyncio
+import json
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+
+import aio_pika
+from aio_pika import Message
+from aio_pika.abc import AbstractChannel, AbstractExchange, AbstractIncomingMessage
+from pydantic import ValidationError
+
+import config
+import electricall_bills as eb
+import metrics
+from electrical_bills_handler import EVENTS_ROUTING_KEY, collect_events, deadline_expired, execute_request, \
+    format_response, legacy_routing_key, merge_events, observe_queue_wait, require_indexes, shard_queue_name, \
+    shard_routing_key
+from electrical_bills_updates_validator import ActionRequest, LegacyActionRequest, validate_update
+from idempotency import IdempotencyStore
+
+
+class ReadWriteLock:
+    """Спільний доступ для показів і виключний для змін тарифу.
+
+    Зміна тарифу, що чекає на лок, не пропускає вперед нові покази, тож потік показів її не блокує.
+    """
+
+    def __init__(self):
+        self.__readers = 0
+        self.__writer = False
+        self.__waiting_writers = 0
+        self.__condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def shared(self):
+        async with self.__condition:
+            await self.__condition.wait_for(lambda: not self.__writer and not self.__waiting_writers)
+            self.__readers += 1
+        try:
+            yield
+        finally:
+            async with self.__condition:
+                self.__readers -= 1
+                self.__condition.notify_all()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self.__condition:
+            self.__waiting_writers += 1
+            try:
+                await self.__condition.wait_for(lambda: not self.__writer and not self.__readers)
+            finally:
+                self.__waiting_writers -= 1
+            self.__writer = True
+        try:
+            yield
+        finally:
+            async with self.__condition:
+                self.__writer = False
+                self.__condition.notify_all()
+
+
+class KeyedLocks:
+    """Локи за ключем (meter_id), що існують лише поки їх хтось тримає або чекає."""
+
+    def __init__(self):
+        self.__locks: dict = {}
+
+    @asynccontextmanager
+    async def hold(self, keys: Iterable):
+        # Однаковий порядок захоплення кількох ключів виключає взаємне блокування пакетів
+        entries = []
+        for key in sorted(set(keys)):
+            entry = self.__locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            entries.append((key, entry))
+        try:
+            async with AsyncExitStack() as stack:
+                for _, (lock, _) in entries:
+                    await stack.enter_async_context(lock)
+                yield
+        finally:
+            for key, entry in entries:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.__locks[key]
+
+    def __len__(self):
+        return len(self.__locks)
+
+
+def lock_scope(request: ActionRequest | LegacyActionRequest) -> tuple[bool, list[int]]:
+    """Чи потребує запит виключного доступу, та лічильники, які він змінює."""
+    data = request.data
+    match data.type:
+        case "add_meter_data" | "add_meter":
+            return False, [data.meter_id]
+        case "add_meter_data_batch":
+            return False, [reading.meter_id for reading in data.readings]
+    # Тариф впливає на вартість усіх наступних показів
+    return True, []
+
+
+class AsyncHandler:
+    """Обробляє до concurrency повідомлень одночасно.
+
+    ElectricalBills працює з синхронним pymongo, тож запити виконуються в пулі потоків, а
+    послідовність зберігається лише там, де вона потрібна: для показів одного лічильника та змін тарифу.
+    """
+
+    def __init__(self, bm: eb.ElectricalBills, idempotency: IdempotencyStore, channel: AbstractChannel,
+                 exchange: AbstractExchange, concurrency: int):
+        self.bm = bm
+        self.idempotency = idempotency
+        self.channel = channel
+        self.exchange = exchange
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="electrical-bills")
+        self.meter_locks = KeyedLocks()
+        self.tariff_lock = ReadWriteLock()
+
+    async def on_message(self, message: AbstractIncomingMessage):
+        if deadline_expired(message):
+            metrics.EXPIRED_REQUESTS.inc()
+            await message.ack()
+            return
+
+        observe_queue_wait(message)
+        request = validate_update(message.body)
+        if isinstance(request, ValidationError):
+            metrics.REQUESTS.inc(type="unknown", status="error")
+            e_response = request
+            request = None
+        else:
+            try:
+                e_response = await self.execute(request)
+            except Exception as e:
+                metrics.HANDLER_ERRORS.inc(stage="execute")
+                print(e)
+                await message.nack(requeue=True)
+                return
+
+        try:
+            await self.publish_response(message, legacy_routing_key(request, message.body), e_response)
+            await self.publish_events(collect_events(request, e_response))
+        except Exception as e:
+            metrics.HANDLER_ERRORS.inc(stage="publish")
+            print(e)
+
+        await message.ack()
+
+    async def execute(self, request: ActionRequest | LegacyActionRequest):
+        exclusive, meter_ids = lock_scope(request)
+        loop = asyncio.get_running_loop()
+        async with AsyncExitStack() as stack:
+            if exclusive:
+                await stack.enter_async_context(self.tariff_lock.exclusive())
+            else:
+                # Лок лічильника береться першим: черга на ньому зберігає порядок надходження показів
+                await stack.enter_async_context(self.meter_locks.hold(meter_ids))
+                await stack.enter_async_context(self.tariff_lock.shared())
+            return await loop.run_in_executor(self.executor, execute_request, self.bm, self.idempotency, request)
+
+    async def publish_response(self, message: AbstractIncomingMessage, routing_key: str | None, e_response):
+        body = json.dumps({"response": format_response(e_response)}).encode()
+        if message.reply_to:
+            await self.channel.default_exchange.publish(
+                Message(body, correlation_id=message.correlation_id), routing_key=message.reply_to)
+        elif routing_key:
+            await self.exchange.publish(Message(body), routing_key=routing_key)
+
+    async def publish_events(self, events: list[dict]):
+        for event in merge_events(events):
+            await self.exchange.publish(Message(json.dumps(event).encode()), routing_key=EVENTS_ROUTING_KEY)
+
+    async def on_event(self, message: AbstractIncomingMessage):
+        try:
+            event: dict = json.loads(message.body)
+        except ValueError:
+            return
+        # Інші воркери тримають поточний тариф у кеші
+        if event.get("event") == "tariff_changed":
+            self.bm.invalidate_current_tariff()
+        # Покази, записані імпортом в обхід обробника
+        elif event.get("event") == "readings_imported":
+            self.bm.invalidate_meters(event.get("meter_ids", []))
+
+
+async def run_worker(shard: int, shards: int, concurrency: int, prefetch: int | None = None):
+    # Потоки одночасно беруть з'єднання з пулу pymongo, тож він не має бути меншим за concurrency
+    client = config.mongo_client(f"handler.{shard}", maxPoolSize=max(config.MONGO_MAX_POOL_SIZE, concurrency))
+    db = config.database(client)
+    bm = eb.ElectricalBills(db)
+    idempotency = IdempotencyStore(db)
+    # Кожен потік пулу бере власне з'єднання
+    config.warm_up_pool(client, concurrency)
+    require_indexes(bm, idempotency)
+    bm.warm_up()
+
+    connection = await aio_pika.connect_robust(config.AMQP_URL)
+    async with connection:
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=prefetch or concurrency)
+        exchange = await channel.declare_exchange("electrical_bills", aio_pika.ExchangeType.DIRECT)
+        handler = AsyncHandler(bm, idempotency, channel, exchange, concurrency)
+
+        queue = await channel.declare_queue(shard_queue_name(shard, shards))
+        await queue.bind(exchange, routing_key=shard_routing_key(shard, shards))
+
+        events_queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+        await events_queue.bind(exchange, routing_key=EVENTS_ROUTING_KEY)
+        await events_queue.consume(handler.on_event, no_ack=True)
+
+        await queue.consume(handler.on_message)
+        # Поки robust-з'єднання перепідключається, воркер не готовий
+        connection.close_callbacks.add(lambda *_: metrics.READY.clear())
+        connection.reconnect_callbacks.add(lambda *_: metrics.READY.set())
+        metrics.READY.set()
+        try:
+            await asyncio.Future()
+        finally:
+            handler.executor.shutdown(wait=True)
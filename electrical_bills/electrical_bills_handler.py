@@ -1,42 +1,350 @@
+import argparse
+import asyncio
+import multiprocessing
+import time
+from contextlib import nullcontext
 from typing import Optional
 
-from pika.adapters.blocking_connection import BlockingChannel
-from pymongo import MongoClient
+from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
+import config
 import electricall_bills as eb
-from electrical_bills_updates_validator import validate_and_execute_update
+from pydantic import ValidationError
+from electrical_bills_updates_validator import ActionRequest, LegacyActionRequest, \
+    execute_update as execute_validated_update, validate_update
+from electricall_bills_exceptions import FakeMeterDataError, PartialBulkWriteError
+from idempotency import IdempotencyStore
 
 import pika
 import json
 
+import metrics
 
-__client = MongoClient("localhost", 27017)
-__db = __client["electrical_bills"]
-__bm = eb.ElectricalBills(__db)
+
+# Створюються в run_worker: кожен процес-воркер має власний пул з'єднань
+__bm: Optional[eb.ElectricalBills] = None
+__idempotency: Optional[IdempotencyStore] = None
+connection: Optional[BlockingConnection] = None
 channel: Optional[BlockingChannel] = None
 
-def callback(ch, method, _, body):
-    update: dict = json.loads(body)
-    e_response = validate_and_execute_update(__bm, update)
+EVENTS_ROUTING_KEY = "electrical.bills.events"
+# Запити, записи яких BatchConsumer накопичує в ElectricalBills.bulk()
+BULK_REQUEST_TYPES = ("add_meter_data", "add_meter_data_batch")
+
+
+def shard_routing_key(shard: int, shards: int) -> str:
+    # Один шард використовує стару назву, щоб не ламати існуючі розгортання
+    if shards <= 1:
+        return "electrical.bills.updates"
+    return f"electrical.bills.updates.{shard}"
+
+
+def shard_queue_name(shard: int, shards: int) -> str:
+    if shards <= 1:
+        return "electrical_bills_updates"
+    return f"electrical_bills_updates.{shard}"
+
+
+def collect_events(request: ActionRequest | LegacyActionRequest | None,
+                   e_response: Exception | list[Exception | None] | None) -> list[dict]:
+    """Події про успішні зміни для інвалідації кешів у воркерах обробника та web_app."""
+    # Накручені покази теж записуються, тож для кешів це успішна зміна
+    if isinstance(e_response, FakeMeterDataError):
+        e_response = None
+    if request is None or (e_response and not isinstance(e_response, list)):
+        return []
+
+    data = request.data
+    match data.type:
+        case "add_meter_data":
+            return [{"event": "readings_added", "meter_ids": [data.meter_id]}]
+        case "add_meter_data_batch":
+            meter_ids = {reading.meter_id for reading, error in zip(data.readings, e_response or [])
+                         if not error or isinstance(error, FakeMeterDataError)}
+            return [{"event": "readings_added", "meter_ids": sorted(meter_ids)}] if meter_ids else []
+        case "add_meter":
+            return [{"event": "meter_added", "meter_id": data.meter_id}]
+        case "add_tariff":
+            return [{"event": "tariff_changed" if data.set_as_current else "tariff_added"}]
+        case "set_tariff":
+            return [{"event": "tariff_changed"}]
+    return []
+
+
+def merge_events(events: list[dict]) -> list[dict]:
+    # Покази з одного пакету зливаються в одну подію
+    merged: dict[str, dict] = {}
+    for event in events:
+        if event["event"] == "readings_added" and "readings_added" in merged:
+            merged["readings_added"]["meter_ids"] = sorted(
+                set(merged["readings_added"]["meter_ids"]) | set(event["meter_ids"]))
+        elif event["event"] == "meter_added":
+            merged[f"meter_added.{event['meter_id']}"] = event
+        else:
+            merged[event["event"]] = event
+    return list(merged.values())
+
+
+def publish_events(events: list[dict]):
+    for event in merge_events(events):
+        channel.basic_publish(
+            exchange="electrical_bills",
+            routing_key=EVENTS_ROUTING_KEY,
+            body=json.dumps(event).encode()
+        )
+
+
+def on_event(ch, method, properties, body):
+    try:
+        event: dict = json.loads(body)
+    except ValueError:
+        return
+    # Інші воркери тримають поточний тариф у кеші
+    if event.get("event") == "tariff_changed":
+        __bm.invalidate_current_tariff()
+    # Покази, записані імпортом в обхід обробника
+    elif event.get("event") == "readings_imported":
+        __bm.invalidate_meters(event.get("meter_ids", []))
+
+
+def format_response(e_response: Exception | list[Exception | None] | None):
+    if isinstance(e_response, list):
+        return [format_response(row) for row in e_response]
+    return e_response if not e_response else str(e_response)
+
+
+def legacy_routing_key(request: ActionRequest | LegacyActionRequest | None, body: bytes) -> Optional[str]:
+    """routing_key для відповіді за старим протоколом, у якому він передається в тілі повідомлення."""
+    if request is not None:
+        return request.routing_key
+    # Повідомлення не пройшло валідацію, тож routing_key шукаємо в сирому JSON
+    try:
+        update = json.loads(body)
+    except ValueError:
+        return None
+    return update.get("routing_key") if isinstance(update, dict) else None
+
+
+def publish_response(properties: pika.BasicProperties, routing_key: Optional[str],
+                     e_response: Exception | list[Exception | None] | None):
+    body = json.dumps({"response": format_response(e_response)}).encode()
+
+    # RPC через спільну чергу відповідей веб-воркера
+    if properties is not None and properties.reply_to:
+        channel.basic_publish(
+            exchange="",
+            routing_key=properties.reply_to,
+            properties=pika.BasicProperties(correlation_id=properties.correlation_id),
+            body=body
+        )
+    # Старий протокол: routing_key у тілі повідомлення
+    elif routing_key:
+        channel.basic_publish(
+            exchange="electrical_bills",
+            routing_key=routing_key,
+            body=body
+        )
+
+
+def observe_queue_wait(properties: pika.BasicProperties):
+    published_at = (properties.headers or {}).get("x-published-at") if properties is not None else None
+    if published_at:
+        metrics.QUEUE_WAIT_SECONDS.observe(max(0.0, time.time() - published_at))
+
+
+def deadline_expired(properties: pika.BasicProperties) -> bool:
+    """Чи минув дедлайн, після якого web_app вже не чекає на відповідь."""
+    deadline = (properties.headers or {}).get("x-deadline") if properties is not None else None
+    return bool(deadline) and time.time() > deadline
+
+
+def execute_update(bm: eb.ElectricalBills, idempotency: IdempotencyStore, properties: pika.BasicProperties,
+                   body: bytes) -> tuple[ActionRequest | LegacyActionRequest | None,
+                                         Exception | list[Exception | None] | None]:
+    """Валідує сире тіло повідомлення і виконує запит; повертає провалідований запит і результат."""
+    observe_queue_wait(properties)
+    request = validate_update(body)
+    if isinstance(request, ValidationError):
+        metrics.REQUESTS.inc(type="unknown", status="error")
+        return None, request
+    return request, execute_request(bm, idempotency, request)
+
+
+def execute_request(bm: eb.ElectricalBills, idempotency: IdempotencyStore,
+                    request: ActionRequest | LegacyActionRequest) -> Exception | list[Exception | None] | None:
+    request_type = request.data.type
+    with metrics.REQUEST_SECONDS.time(type=request_type):
+        e_response = execute_validated_update(bm, request, idempotency)
+    status = "error" if e_response and not isinstance(e_response, list) else "ok"
+    metrics.REQUESTS.inc(type=request_type, status=status)
+    return e_response
+
+
+def callback(ch, method, properties, body):
+    if deadline_expired(properties):
+        metrics.EXPIRED_REQUESTS.inc()
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    request, e_response = execute_update(__bm, __idempotency, properties, body)
 
     try:
-        if "routing_key" in update:
-            channel.basic_publish(
-                exchange="electrical_bills",
-                routing_key=update.get("routing_key"),
-                body=json.dumps({"response": e_response if not e_response else str(e_response)}).encode()
-            )
+        publish_response(properties, legacy_routing_key(request, body), e_response)
+        publish_events(collect_events(request, e_response))
     except Exception as e:
+        metrics.HANDLER_ERRORS.inc(stage="publish")
         print(e)
 
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
-def main():
-    global channel
-    connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+class BatchConsumer:
+    """Збирає до batch_size повідомлень або чекає batch_timeout секунд і обробляє їх одним bulk_write."""
+
+    def __init__(self, bm: eb.ElectricalBills, idempotency: IdempotencyStore, batch_size: int, batch_timeout: float):
+        self.bm = bm
+        self.idempotency = idempotency
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch: list[tuple] = []
+        self.timer = None
+
+    def callback(self, ch, method, properties, body):
+        self.batch.append((method, properties, body))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = connection.call_later(self.batch_timeout, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            connection.remove_timeout(self.timer)
+            self.timer = None
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        last_tag = batch[-1][0].delivery_tag
+
+        messages = []
+        for method, properties, body in batch:
+            # Прострочений запит не виконуємо, щоб повтор з тим самим ключем пройшов як новий
+            if deadline_expired(properties):
+                metrics.EXPIRED_REQUESTS.inc()
+                messages.append((method, properties, body, None, None))
+                continue
+            observe_queue_wait(properties)
+            request = validate_update(body)
+            if isinstance(request, ValidationError):
+                metrics.REQUESTS.inc(type="unknown", status="error")
+                messages.append((method, properties, body, None, request))
+            else:
+                messages.append((method, properties, body, request, None))
+
+        # Покази з кількох повідомлень пишуться одним bulk_write, а решта запитів пише в базу одразу.
+        # Тому такий запит виконується окремо, після підтвердження попередніх повідомлень: інакше збій
+        # bulk_write повернув би його в чергу, і повтор записав би те саме вдруге
+        start = 0
+        for end, (_, _, _, request, _) in enumerate(messages):
+            if request is None or request.data.type in BULK_REQUEST_TYPES:
+                continue
+            if not self.process(messages[start:end], bulk=True) or not self.process([messages[end]], bulk=False):
+                channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+                return
+            start = end + 1
+        if not self.process(messages[start:], bulk=True):
+            channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+
+    def process(self, messages: list[tuple], bulk: bool) -> bool:
+        """Виконує повідомлення в порядку надходження, відповідає на них і підтверджує.
+
+        Повертає False, якщо нічого не записано і повідомлення треба повернути в чергу.
+        """
+        if not messages:
+            return True
+
+        responses = []
+        try:
+            with self.idempotency.bulk() if bulk else nullcontext(), self.bm.bulk() if bulk else nullcontext():
+                for _, properties, body, request, error in messages:
+                    if request is not None:
+                        responses.append((properties, body, request, execute_request(self.bm, self.idempotency,
+                                                                                     request)))
+                    elif error:
+                        responses.append((properties, body, None, error))
+        except PartialBulkWriteError as e:
+            # Частину записів уже застосовано, тож повтор з черги її продублював би. Клієнти отримують
+            # помилку, а кеші скидаються так, ніби записано все
+            metrics.HANDLER_ERRORS.inc(stage="bulk_write")
+            print(e)
+            partial = Exception("Пакет записано частково. Перевірте останні покази перед повторним надсиланням.")
+            responses = [(properties, body, request, partial if request is not None else error)
+                         for _, properties, body, request, error in messages if request is not None or error]
+            events = [event for _, _, request, _ in responses for event in collect_events(request, None)]
+        except Exception as e:
+            metrics.HANDLER_ERRORS.inc(stage="bulk_write")
+            print(e)
+            return False
+        else:
+            events = [event for _, _, request, e_response in responses
+                      for event in collect_events(request, e_response)]
+
+        for properties, body, request, e_response in responses:
+            try:
+                publish_response(properties, legacy_routing_key(request, body), e_response)
+            except Exception as e:
+                metrics.HANDLER_ERRORS.inc(stage="publish")
+                print(e)
+
+        try:
+            publish_events(events)
+        except Exception as e:
+            metrics.HANDLER_ERRORS.inc(stage="publish")
+            print(e)
+
+        channel.basic_ack(delivery_tag=messages[-1][0].delivery_tag, multiple=True)
+        return True
+
+
+def require_indexes(bm: eb.ElectricalBills, idempotency: IdempotencyStore):
+    """Воркер не стартує без унікальних індексів, без яких add_meter не помітить дубліката лічильника,
+    і без TTL-індексу ключів ідемпотентності, без якого processed_requests росте без обмеження."""
+    missing = bm.missing_indexes() + idempotency.missing_indexes()
+    if missing:
+        raise SystemExit(f"Missing indexes: {', '.join(missing)}. Run `python manage.py create-indexes` "
+                         f"before starting the handler")
+
+
+def run_worker(shard: int, shards: int, batch_size: int, batch_timeout_ms: int, prefetch: Optional[int],
+               metrics_port: int = 0, concurrency: int = 0):
+    global connection, channel, __bm, __idempotency
+    if metrics_port:
+        # Зайнятий порт не має зупиняти обробку: інакше supervise перезапускав би воркер без кінця
+        try:
+            metrics.start_http_server(metrics_port, config.METRICS_HOST)
+        except OSError as e:
+            print(f"Metrics endpoint disabled, can't bind {config.METRICS_HOST}:{metrics_port}: {e}")
+
+    if concurrency:
+        import async_handler
+
+        asyncio.run(async_handler.run_worker(shard, shards, concurrency, prefetch))
+        return
+
+    client = config.mongo_client(f"handler.{shard}")
+    db = config.database(client)
+    __bm = eb.ElectricalBills(db)
+    __idempotency = IdempotencyStore(db)
+    # Прогрів до підписки на чергу: перші повідомлення не чекають на з'єднання з MongoDB і холодний кеш.
+    # Індекси тут не створюються, для цього є manage.py create-indexes; їх наявність лише перевіряється
+    config.warm_up_pool(client, 1)
+    require_indexes(__bm, __idempotency)
+    __bm.warm_up()
+
+    connection = pika.BlockingConnection(config.amqp_parameters())
     channel = connection.channel()
+    channel.basic_qos(prefetch_count=prefetch or 2 * batch_size)
 
-    queue_consume = channel.queue_declare('electrical_bills_updates')
+    queue_consume = channel.queue_declare(shard_queue_name(shard, shards))
     queue_name = queue_consume.method.queue
 
     channel.exchange_declare(exchange="electrical_bills", exchange_type="direct")
@@ -44,12 +352,83 @@ def main():
     channel.queue_bind(
         exchange="electrical_bills",
         queue=queue_name,
-        routing_key="electrical.bills.updates"
+        routing_key=shard_routing_key(shard, shards)
     )
 
-    channel.basic_consume(on_message_callback=callback, queue=queue_name)
+    events_queue = channel.queue_declare("", exclusive=True).method.queue
+    channel.queue_bind(exchange="electrical_bills", queue=events_queue, routing_key=EVENTS_ROUTING_KEY)
+    channel.basic_consume(on_message_callback=on_event, queue=events_queue, auto_ack=True)
+
+    if batch_size > 1:
+        consumer = BatchConsumer(__bm, __idempotency, batch_size, batch_timeout_ms / 1000)
+        channel.basic_consume(on_message_callback=consumer.callback, queue=queue_name)
+    else:
+        channel.basic_consume(on_message_callback=callback, queue=queue_name)
+    metrics.READY.set()
     channel.start_consuming()
 
 
+def supervise(workers: int, batch_size: int, batch_timeout_ms: int, prefetch: Optional[int],
+              metrics_port: int = 0, concurrency: int = 0):
+    """Запускає по воркеру на шард і перезапускає ті, що впали.
+
+    Кожен воркер віддає метрики на власному порту: metrics_port + номер шарду.
+    """
+    context = multiprocessing.get_context("spawn")
+
+    def start(shard: int):
+        worker_metrics_port = metrics_port + shard if metrics_port else 0
+        process = context.Process(target=run_worker,
+                                  args=(shard, workers, batch_size, batch_timeout_ms, prefetch, worker_metrics_port,
+                                        concurrency),
+                                  name=f"electrical-bills-worker-{shard}", daemon=True)
+        process.start()
+        return process
+
+    processes = {shard: start(shard) for shard in range(workers)}
+    try:
+        while True:
+            time.sleep(1)
+            for shard, process in processes.items():
+                if not process.is_alive():
+                    print(f"Worker {shard} exited with code {process.exitcode}, restarting")
+                    processes[shard] = start(shard)
+    except KeyboardInterrupt:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="кількість повідомлень у пакеті; 1 вимикає пакетний режим")
+    parser.add_argument("--batch-timeout-ms", type=int, default=50,
+                        help="максимальний час очікування на заповнення пакету")
+    parser.add_argument("--prefetch", type=int, default=None,
+                        help="prefetch count каналу (за замовчуванням 2 * batch-size)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="запустити супервізор з N воркерами, по одному на шард")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="загальна кількість шардів (має збігатися з HANDLER_SHARDS у web_app)")
+    parser.add_argument("--shard", type=int, default=0, help="номер шарду цього воркера")
+    parser.add_argument("--metrics-port", type=int, default=config.METRICS_PORT,
+                        help="базовий порт HTTP-ендпоінту /metrics, до якого додається номер шарду; 0 вимикає")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="асинхронний режим (aio-pika) з N запитами в обробці одночасно; 0 — синхронний pika")
+    args = parser.parse_args()
+    if args.concurrency and args.batch_size > 1:
+        parser.error("--concurrency can't be combined with --batch-size")
+
+    if args.workers:
+        supervise(args.workers, args.batch_size, args.batch_timeout_ms, args.prefetch, args.metrics_port,
+                  args.concurrency)
+    else:
+        # Як і в supervise: окремі воркери різних шардів на одному хості не ділять порт метрик
+        run_worker(args.shard, args.shards, args.batch_size, args.batch_timeout_ms, args.prefetch,
+                   args.metrics_port + args.shard if args.metrics_port else 0, args.concurrency)
+
+
 if __name__ == "__main__":
     main()
@@ -1,50 +1,153 @@
-from pydantic import BaseModel, ValidationError
-from typing import Union
+from contextlib import nullcontext
+
+from pydantic import BaseModel, Field, ValidationError
+from typing import Annotated, Literal, Union, Optional
 from electricall_bills import ElectricalBills
+from idempotency import IdempotencyStore
 from electricall_bills_exceptions import *
+from metrics import VALIDATION_SECONDS, VALIDATION_FAILURES
+
+# Відповідь на показ, збережений зі скоригованим споживанням; запис при цьому відбувся
+FAKE_METER_DATA_MESSAGE = ("Покази лічильника було накручено, "
+                           "тому було автоматично встановленно споживання (див. таблицю).")
+
+# Помилки, що залежать лише від запиту та стану даних, тож повтор з тим самим ключем отримає ту саму
+# відповідь. Збої бази й інші тимчасові помилки не зберігаються, і повтор виконується заново
+STORED_ERRORS = {error.__name__: error for error in (
+    MeterIdNotFoundError, TariffIsNotSetError, NegativeValuesError, NightTariffIsLowerThanZero,
+    DayTariffIsLowerThanZero, FakeMeterDataError, MeterAlreadyExistsError, TariffNotFoundError, ValueError
+)}
 
 
 class AddMeterDataRequest(BaseModel):
+    type: Literal["add_meter_data"] = "add_meter_data"
     meter_id: int
     day: float
     night: float
+    idempotency_key: Optional[str] = None
+
+
+class AddMeterDataBatchRequest(BaseModel):
+    type: Literal["add_meter_data_batch"] = "add_meter_data_batch"
+    readings: list[AddMeterDataRequest]
 
 
 class AddMeterRequest(BaseModel):
+    type: Literal["add_meter"] = "add_meter"
     meter_id: int
+    idempotency_key: Optional[str] = None
 
 
 class AddTariffRequest(BaseModel):
+    type: Literal["add_tariff"] = "add_tariff"
     day_tariff: float
     night_tariff: float
     set_as_current: bool = False
+    idempotency_key: Optional[str] = None
 
 
 class SetTariffRequest(BaseModel):
+    type: Literal["set_tariff"] = "set_tariff"
     tariff_id: str
+    idempotency_key: Optional[str] = None
+
+
+UpdateRequest = Union[AddMeterDataRequest, AddMeterDataBatchRequest, AddMeterRequest, AddTariffRequest,
+                      SetTariffRequest]
 
 
 class ActionRequest(BaseModel):
-    data: Union[AddMeterDataRequest, AddMeterRequest, AddTariffRequest, SetTariffRequest]
-    routing_key: str
+    # За тегом type pydantic одразу обирає модель замість перебору варіантів Union
+    data: Annotated[UpdateRequest, Field(discriminator="type")]
+    routing_key: Optional[str] = None
 
 
-def validate_and_execute_update(eb: ElectricalBills, message: dict) -> Exception | None:
+class LegacyActionRequest(BaseModel):
+    """Повідомлення старих клієнтів без type; модель підбирається перебором варіантів Union."""
+    data: UpdateRequest
+    routing_key: Optional[str] = None
+
+
+def parse_update(message: bytes | str | dict) -> ActionRequest | LegacyActionRequest:
+    """Валідує повідомлення; сирі байти тіла розбираються pydantic без проміжного json.loads."""
+    if isinstance(message, dict):
+        validate, validate_legacy = ActionRequest.model_validate, LegacyActionRequest.model_validate
+    else:
+        validate, validate_legacy = ActionRequest.model_validate_json, LegacyActionRequest.model_validate_json
+
     try:
-        validated_request = ActionRequest(**message)
+        return validate(message)
     except ValidationError as e:
+        if not any(error["type"] == "union_tag_not_found" for error in e.errors()):
+            raise
+    return validate_legacy(message)
+
+
+def validate_update(message: bytes | str | dict) -> ActionRequest | LegacyActionRequest | ValidationError:
+    try:
+        with VALIDATION_SECONDS.time():
+            return parse_update(message)
+    except ValidationError as e:
+        VALIDATION_FAILURES.inc()
         return e
 
+
+def validate_and_execute_update(eb: ElectricalBills, message: bytes | str | dict,
+                                idempotency: IdempotencyStore | None = None
+                                ) -> Exception | list[Exception | None] | None:
+    validated_request = validate_update(message)
+    if isinstance(validated_request, ValidationError):
+        return validated_request
+    return execute_update(eb, validated_request, idempotency)
+
+
+def execute_update(eb: ElectricalBills, validated_request: ActionRequest | LegacyActionRequest,
+                   idempotency: IdempotencyStore | None = None) -> Exception | list[Exception | None] | None:
+    # Пакет показів виконується по рядку, результат повертається для кожного рядка окремо
+    if isinstance(validated_request.data, AddMeterDataBatchRequest):
+        try:
+            with idempotency.bulk() if idempotency else nullcontext(), eb.bulk():
+                return [execute_idempotent_request(eb, reading, idempotency)
+                        for reading in validated_request.data.readings]
+        except Exception as e:
+            return e
+
+    return execute_idempotent_request(eb, validated_request.data, idempotency)
+
+
+def execute_idempotent_request(eb: ElectricalBills, request: BaseModel,
+                               idempotency: IdempotencyStore | None) -> Exception | None:
+    """Повтор запиту з відомим ключем отримує збережений результат без повторного запису."""
+    key = getattr(request, "idempotency_key", None)
+    if not key or idempotency is None:
+        return execute_request(eb, request)
+
+    found, result = idempotency.get(key)
+    if found:
+        if not result["error"]:
+            return None
+        # Записи без типу помилки збережені до того, як тип почав зберігатися
+        return STORED_ERRORS.get(result.get("error_type"), Exception)(result["error"])
+
+    e_response = execute_request(eb, request)
+    if not e_response:
+        idempotency.put(key, {"error": None}, eb.pending_readings())
+        return e_response
+
+    error_type = next((name for name, error in STORED_ERRORS.items() if isinstance(e_response, error)), None)
+    if error_type:
+        idempotency.put(key, {"error": str(e_response), "error_type": error_type}, eb.pending_readings())
+    return e_response
+
+
+def execute_request(eb: ElectricalBills, request: BaseModel) -> Exception | None:
     try:
-        match validated_request.data:
+        match request:
             case AddMeterDataRequest(day=day, night=night, meter_id=meter_id):
                 try:
                     cost, fake = eb.add_meter_data(meter_id=meter_id, day=day, night=night)
                     if fake:
-                        raise Exception(
-                            "Покази лічильника було накручено, "
-                            "тому було автоматично встановленно споживання (див. таблицю)."
-                        )
+                        raise FakeMeterDataError(FAKE_METER_DATA_MESSAGE)
                 except NegativeValuesError:
                     raise NegativeValuesError("Було отримано від'ємне число.")
                 except MeterIdNotFoundError:
@@ -53,14 +156,14 @@ def validate_and_execute_update(eb: ElectricalBills, message: dict) -> Exception
                     raise TariffIsNotSetError("Не можна ввести показники поки не встановлено тариф.")
             case AddMeterRequest(meter_id=meter_id):
                 if not eb.add_meter(meter_id=meter_id):
-                    raise Exception(f"Айді лічільника {meter_id} вже існує. Спробуйте інший.")
+                    raise MeterAlreadyExistsError(f"Айді лічільника {meter_id} вже існує. Спробуйте інший.")
             case AddTariffRequest(day_tariff=day_tariff, night_tariff=night_tariff, set_as_current=set_as_current):
                 try:
                     eb.add_tariff(day_tariff=day_tariff, night_tariff=night_tariff, set_as_current=set_as_current)
-                except Exception:
+                except (DayTariffIsLowerThanZero, NightTariffIsLowerThanZero):
                     raise DayTariffIsLowerThanZero("Тариф не може бути безшкоштовним або мати від'ємне значення")
             case SetTariffRequest(tariff_id=tariff_id):
                 if not eb.set_tariff(tariff_id=tariff_id):
-                    raise Exception(f"Айді тарифу зі значенням {tariff_id} не існує. Спробуйте інший.")
+                    raise TariffNotFoundError(f"Айді тарифу зі значенням {tariff_id} не існує. Спробуйте інший.")
     except Exception as e:
         return e
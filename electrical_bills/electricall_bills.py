@@ -1,30 +1,236 @@
-from collections.abc import Mapping
+import heapq
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable, Mapping
+from contextlib import contextmanager
 from typing import Union
 
 import bson.errors
 import pymongo
 from datetime import datetime
 
-from pymongo.errors import DuplicateKeyError
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pymongo.synchronous.database import Database
 from bson.objectid import ObjectId
 
+from anomaly import MeterProfile, ROLLBACK
+from readings_archive import archive_pipeline
 from electricall_bills_exceptions import *
+from metrics import MONGO_SECONDS, FAKE_READINGS, READING_ANOMALIES
 
 
+# Споживання за аномальні покази, поки профіль лічильника ще не накопичено (див. anomaly.MeterProfile)
 _DAY_DEFAULT = 100
 _NIGHT_DEFAULT = 80
+_CACHE_SIZE = 10_000
+
+
+class LRUCache:
+    def __init__(self, max_size: int = _CACHE_SIZE):
+        self.max_size = max_size
+        self.__data = OrderedDict()
+        # Асинхронний обробник звертається до кешу з кількох потоків
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                self.__data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.__data[key]
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+            if len(self.__data) > self.max_size:
+                self.__data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            return self.__data.pop(key, default)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+
+class _BulkBuffers(threading.local):
+    meters_data: list | None = None
+    general_data: dict | None = None
+    rollups: dict | None = None
+    profiles: dict | None = None
 
 
 class ElectricalBills:
-    def __init__(self, db: Database):
+    def __init__(self, db: Database, cache_size: int = _CACHE_SIZE):
         self.meters_data = db['meters_data']
-        self.meters_data.create_index([("date_time", pymongo.DESCENDING)])
         self.tariff_history = db['tariff_history']
-        self.tariff_history.create_index([("date_time", pymongo.DESCENDING)])
+        # Моменти, з яких тариф став поточним; з них будується TariffTimeline
+        self.tariff_activations = db["tariff_activations"]
         self.meters = db["meters"]
-        self.meters.create_index("meter_id", unique=True)
         self.general_data = db["general_data"]
+        # Інкрементальні підсумки споживання та вартості по лічильнику за день і за місяць
+        self.meters_daily = db["meters_daily"]
+        self.meters_monthly = db["meters_monthly"]
+        # Середнє та дисперсія споживання кожного лічильника для перевірки нових показів
+        self.meter_profiles = db["meter_profiles"]
+        # Старі покази, перенесені RetentionJob у помісячні бакети лічильників
+        self.meters_archive = db["meters_archive"]
+
+        # Write-through кеш: відомі лічильники, поточний тариф та останні покази кожного лічильника
+        self.__known_meters = LRUCache(cache_size)
+        self.__last_meters_data = LRUCache(cache_size)
+        self.__profiles = LRUCache(cache_size)
+        self.__current_tariff = None
+
+        # Буфери пакетного режиму, див. bulk(); у кожного потоку власні
+        self.__pending = _BulkBuffers()
+
+    def create_indexes(self):
+        """Створює індекси колекцій; запускається один раз міграцією manage.py create-indexes, а не на старті."""
+        # _id входить в індекси як другий ключ сортування для keyset-пагінації
+        self.meters_data.create_index([("date_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        self.meters_data.create_index([("meter_id", pymongo.ASCENDING), ("date_time", pymongo.DESCENDING),
+                                       ("_id", pymongo.DESCENDING)])
+        self.tariff_history.create_index([("date_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        self.tariff_activations.create_index([("date_time", pymongo.ASCENDING)])
+        self.meters.create_index("meter_id", unique=True)
+        self.meters_daily.create_index([("meter_id", pymongo.ASCENDING), ("date", pymongo.ASCENDING)], unique=True)
+        self.meters_monthly.create_index([("meter_id", pymongo.ASCENDING), ("month", pymongo.ASCENDING)],
+                                         unique=True)
+        self.meter_profiles.create_index("meter_id", unique=True)
+        self.meters_archive.create_index([("meter_id", pymongo.ASCENDING), ("month", pymongo.ASCENDING)], unique=True)
+        # Межі бакетів для обходу архіву в порядку сторінки; див. web_app archive_page
+        self.meters_archive.create_index([("last", pymongo.DESCENDING)])
+        self.meters_archive.create_index([("first", pymongo.ASCENDING)])
+
+    def missing_indexes(self) -> list[str]:
+        """Унікальні індекси, на які спирається захист від дублікатів, але яких ще немає в базі."""
+        required = [(self.meters, [("meter_id", 1)]),
+                    (self.meters_daily, [("meter_id", 1), ("date", 1)]),
+                    (self.meters_monthly, [("meter_id", 1), ("month", 1)]),
+                    (self.meter_profiles, [("meter_id", 1)]),
+                    (self.meters_archive, [("meter_id", 1), ("month", 1)])]
+        missing = []
+        for collection, keys in required:
+            indexes = self.__mongo(collection, "index_information").values()
+            if not any(index.get("unique") and [(field, int(order)) for field, order in index["key"]] == keys
+                       for index in indexes):
+                missing.append(f"{collection.name}({', '.join(field for field, _ in keys)})")
+        return missing
+
+    def warm_up(self) -> dict:
+        """Завантажує в кеш поточний тариф і відомі лічильники до того, як воркер почне брати повідомлення."""
+        self.__current_tariff = self.__general_data_get("current_tariff")
+        meters = 0
+        for meter in self.__mongo(self.meters, "find", {}, {"_id": 0, "meter_id": 1},
+                                  limit=self.__known_meters.max_size):
+            self.__known_meters.set(meter["meter_id"], True)
+            meters += 1
+        return {"meters": meters, "current_tariff": self.__current_tariff is not None}
+
+    @contextmanager
+    def bulk(self):
+        """Накопичує записи в meters_data та general_data і відправляє їх одним bulk_write на виході.
+
+        add_meter, add_tariff і set_tariff пишуть одразу й не буферизуються. Якщо запис на виході
+        перервався після того, як частину змін уже застосовано, піднімається PartialBulkWriteError.
+        """
+        # Вкладений bulk() пише в буфер зовнішнього
+        if self.__pending.meters_data is not None:
+            yield self
+            return
+
+        self.__pending.meters_data = []
+        self.__pending.general_data = {}
+        self.__pending.rollups = {}
+        self.__pending.profiles = {}
+        try:
+            yield self
+            self.__flush()
+        except Exception:
+            # Кеш вже містить незаписані зміни
+            self.invalidate_cache()
+            raise
+        finally:
+            self.__pending.meters_data = None
+            self.__pending.general_data = None
+            self.__pending.rollups = None
+            self.__pending.profiles = None
+
+    def __flush(self):
+        written = False
+        inserted = 0
+        try:
+            if self.__pending.meters_data:
+                self.__mongo(self.meters_data, "bulk_write",
+                             [InsertOne(doc) for doc in self.__pending.meters_data], ordered=True)
+                inserted = len(self.__pending.meters_data)
+                written = True
+            # Оновлення general_data згорнуті за _id, тож у пакеті їх не більше одного на ключ
+            for _id, data in self.__pending.general_data.items():
+                self.__mongo(self.general_data, "update_one", {"_id": _id}, {"$set": {"data": data}}, upsert=True)
+                written = True
+            # Інкременти підсумків складені за ключем, тож на лічильник і день — одне оновлення,
+            # а всі оновлення колекції підсумків відправляються одним bulk_write
+            rollups = {}
+            for (collection, key), inc in self.__pending.rollups.items():
+                rollups.setdefault(collection, []).append(UpdateOne(dict(key), {"$inc": inc}, upsert=True))
+            for collection, updates in rollups.items():
+                self.__mongo(collection, "bulk_write", updates, ordered=False)
+                written = True
+            if self.__pending.profiles:
+                self.__mongo(self.meter_profiles, "bulk_write",
+                             [UpdateOne({"meter_id": meter_id}, {"$set": profile.as_doc()}, upsert=True)
+                              for meter_id, profile in self.__pending.profiles.items()], ordered=False)
+                written = True
+        except Exception as e:
+            # Упорядкований bulk_write міг встигнути вставити частину показів до помилки
+            if not written and isinstance(e, BulkWriteError):
+                inserted = e.details.get("nInserted", 0)
+            if written or inserted:
+                raise PartialBulkWriteError("Bulk flush failed after some of its writes were applied", inserted) from e
+            raise
+
+    def pending_readings(self) -> int | None:
+        """Кількість показів у буфері bulk() або None поза пакетом."""
+        return len(self.__pending.meters_data) if self.__pending.meters_data is not None else None
+
+    def __meters_data_insert(self, meter_insert: dict):
+        if self.__pending.meters_data is not None:
+            self.__pending.meters_data.append(meter_insert)
+        else:
+            self.__mongo(self.meters_data, "insert_one", meter_insert)
+
+        self.__last_meters_data.set(meter_insert["meter_id"], meter_insert)
+
+        inc = {"day_usage": meter_insert["day_usage"], "night_usage": meter_insert["night_usage"],
+               "cost": meter_insert["cost"], "readings": 1}
+        for collection, key in self.__rollup_keys(meter_insert["meter_id"], meter_insert["date_time"]):
+            if self.__pending.rollups is None:
+                self.__mongo(collection, "update_one", dict(key), {"$inc": inc}, upsert=True)
+                continue
+            pending = self.__pending.rollups.setdefault((collection, key), dict.fromkeys(inc, 0))
+            for field, value in inc.items():
+                pending[field] += value
+
+    def __rollup_keys(self, meter_id: int, date_time: datetime):
+        return ((self.meters_daily, (("meter_id", meter_id), ("date", date_time.strftime("%Y-%m-%d")))),
+                (self.meters_monthly, (("meter_id", meter_id), ("month", date_time.strftime("%Y-%m")))))
+
+    @staticmethod
+    def __mongo(collection, operation: str, *args, **kwargs):
+        with MONGO_SECONDS.time(collection=collection.name, operation=operation):
+            return getattr(collection, operation)(*args, **kwargs)
 
     @staticmethod
     def __are_dict_values_positive(dict_: dict):
@@ -36,44 +242,51 @@ class ElectricalBills:
         if not ElectricalBills.__are_dict_values_positive(meter_insert):
             raise NegativeValuesError(f"Negative value/values was/were encountered in new meter data")
 
-        if not self.meters.find_one({"meter_id": meter_id}):
+        if not self.__meter_exists(meter_id):
             raise MeterIdNotFoundError(f"There's no meter with id {meter_id}")
 
-        tariff = self.__general_data_get("current_tariff")
+        tariff = self.get_current_tariff()
         if not tariff:
             raise TariffIsNotSetError("No tariff is set")
 
-        meter_insert["tariff"] = tariff
-        last_meters_data = self.__general_data_get("last_meters_data")
+        # Покази посилаються на тариф за id замість копії всього документа тарифу
+        meter_insert["tariff_id"] = tariff["_id"]
+        last_meters_data = self.__get_last_meters_data(meter_id)
 
         if not last_meters_data:
             cost = tariff["day_tariff"] * day + tariff["night_tariff"] * night
-            meter_insert["cost"] = cost
-            self.meters_data.insert_one(meter_insert)
-            self.__general_data_update("last_meters_data", meter_insert)
+            meter_insert.update(cost=cost, day_usage=day, night_usage=night)
+            self.__meters_data_insert(meter_insert)
             return cost, False
 
-        fake = False
-        if last_meters_data["day"] > meter_insert["day"]:
-            fake = True
-            meter_insert["day"] = last_meters_data["day"] + _DAY_DEFAULT
+        profile = self.__get_profile(meter_id)
+        (day_usage, day_anomaly), (night_usage, night_anomaly) = profile.observe(
+            day - last_meters_data["day"], night - last_meters_data["night"], _DAY_DEFAULT, _NIGHT_DEFAULT)
+        self.__profile_update(profile)
 
-        if last_meters_data["night"] > meter_insert["night"]:
-            fake = True
-            meter_insert["night"] = last_meters_data["night"] + _NIGHT_DEFAULT
+        fake = bool(day_anomaly or night_anomaly)
+        if fake:
+            FAKE_READINGS.inc()
+            for anomaly in {day_anomaly, night_anomaly} - {None}:
+                READING_ANOMALIES.inc(kind=anomaly)
+        # Стрибок зберігається з фактичними показами й коригується лише нараховане споживання,
+        # а показ, менший за попередній, як і раніше замінюється на попередній плюс нараховане споживання
+        if day_anomaly == ROLLBACK:
+            meter_insert["day"] = last_meters_data["day"] + day_usage
+        if night_anomaly == ROLLBACK:
+            meter_insert["night"] = last_meters_data["night"] + night_usage
 
-        cost = (tariff["day_tariff"] * (meter_insert["day"] - last_meters_data["day"]) +
-                tariff["night_tariff"] * (meter_insert["night"] - last_meters_data["night"]))
-        meter_insert["cost"] = cost
-        self.meters_data.insert_one(meter_insert)
-        self.__general_data_update("last_meters_data", meter_insert)
+        cost = tariff["day_tariff"] * day_usage + tariff["night_tariff"] * night_usage
+        meter_insert.update(cost=cost, day_usage=day_usage, night_usage=night_usage)
+        self.__meters_data_insert(meter_insert)
         return cost, fake
 
     def add_meter(self, meter_id: int):
         if meter_id < 0:
             raise ValueError(f"Meter id can't be lower than 0. {meter_id} was given.")
         try:
-            self.meters.insert_one({"meter_id": meter_id})
+            self.__mongo(self.meters, "insert_one", {"meter_id": meter_id})
+            self.__known_meters.set(meter_id, True)
             return True
         except DuplicateKeyError:
             return False
@@ -84,7 +297,7 @@ class ElectricalBills:
         if night_tariff <= 0:
             raise NightTariffIsLowerThanZero(f"Night tariff can't be free. {night_tariff} price was given.")
 
-        inserted_id = self.tariff_history.insert_one({
+        inserted_id = self.__mongo(self.tariff_history, "insert_one", {
             "day_tariff": day_tariff,
             "night_tariff": night_tariff,
             "date_time": datetime.now()
@@ -98,7 +311,7 @@ class ElectricalBills:
     def set_tariff(self, tariff_id: str):
         try:
             id = ObjectId(tariff_id)
-            found = self.tariff_history.find_one({"_id": id})
+            found = self.__mongo(self.tariff_history, "find_one", {"_id": id})
         except (TypeError, bson.errors.InvalidId):
             return False
 
@@ -106,17 +319,160 @@ class ElectricalBills:
             return False
 
         self.__general_data_update("current_tariff", found)
+        self.__mongo(self.tariff_activations, "insert_one", {"tariff_id": id, "date_time": datetime.now()})
+        self.__current_tariff = found
         return True
 
+    def correct_tariff(self, tariff_id: str, day_tariff: float, night_tariff: float):
+        """Виправляє ціни збереженого тарифу; вартість вже записаних показів перераховує RebillingJob."""
+        if day_tariff <= 0:
+            raise DayTariffIsLowerThanZero(f"Day tariff can't be free. {day_tariff} price was given.")
+        if night_tariff <= 0:
+            raise NightTariffIsLowerThanZero(f"Night tariff can't be free. {night_tariff} price was given.")
+
+        try:
+            id = ObjectId(tariff_id)
+        except (TypeError, bson.errors.InvalidId):
+            return False
+
+        corrected = self.__mongo(self.tariff_history, "find_one_and_update", {"_id": id},
+                                 {"$set": {"day_tariff": day_tariff, "night_tariff": night_tariff}},
+                                 return_document=pymongo.ReturnDocument.AFTER)
+        if not corrected:
+            return False
+
+        current_tariff = self.get_current_tariff()
+        if current_tariff and current_tariff["_id"] == id:
+            self.__general_data_update("current_tariff", corrected)
+            self.__current_tariff = corrected
+        return True
+
+    def get_daily_usage(self, meter_id: int, date: str):
+        return self.meters_daily.find_one({"meter_id": meter_id, "date": date}, {"_id": 0})
+
+    def get_monthly_usage(self, meter_id: int, month: str):
+        return self.meters_monthly.find_one({"meter_id": meter_id, "month": month}, {"_id": 0})
+
+    def rebuild_rollups(self):
+        """Перераховує денні та місячні підсумки з сирих показів meters_data та meters_archive."""
+        daily, monthly = {}, {}
+        last_meters_data = None
+        sort = [("meter_id", pymongo.ASCENDING), ("date_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+        docs = heapq.merge(self.meters_archive.aggregate(archive_pipeline({}, sort)), self.meters_data.find(sort=sort),
+                           key=lambda doc: (doc["meter_id"], doc["date_time"], doc["_id"]))
+        for doc in docs:
+            if "day_usage" in doc:
+                day_usage, night_usage = doc["day_usage"], doc["night_usage"]
+            elif last_meters_data and last_meters_data["meter_id"] == doc["meter_id"]:
+                day_usage = doc["day"] - last_meters_data["day"]
+                night_usage = doc["night"] - last_meters_data["night"]
+            else:
+                day_usage, night_usage = doc["day"], doc["night"]
+            last_meters_data = doc
+
+            for rollups, (_, key) in zip((daily, monthly), self.__rollup_keys(doc["meter_id"], doc["date_time"])):
+                rollup = rollups.setdefault(key, {"day_usage": 0, "night_usage": 0, "cost": 0, "readings": 0})
+                rollup["day_usage"] += day_usage
+                rollup["night_usage"] += night_usage
+                rollup["cost"] += doc["cost"]
+                rollup["readings"] += 1
+
+        for collection, rollups in ((self.meters_daily, daily), (self.meters_monthly, monthly)):
+            collection.delete_many({})
+            if rollups:
+                collection.insert_many([dict(key, **rollup) for key, rollup in rollups.items()])
+
+    def get_current_tariff(self):
+        if self.__current_tariff is None:
+            self.__current_tariff = self.__general_data_get("current_tariff")
+        return self.__current_tariff
+
+    def invalidate_current_tariff(self):
+        self.__current_tariff = None
+
+    def invalidate_meters(self, meter_ids: Iterable[int]):
+        """Скидає закешовані останні покази й профілі лічильників, записаних в обхід цього екземпляра."""
+        for meter_id in meter_ids:
+            self.__last_meters_data.pop(meter_id)
+            self.__profiles.pop(meter_id)
+
+    def invalidate_cache(self):
+        self.__known_meters.clear()
+        self.__last_meters_data.clear()
+        self.__profiles.clear()
+        self.__current_tariff = None
+
+    def __meter_exists(self, meter_id: int) -> bool:
+        if self.__known_meters.get(meter_id):
+            return True
+
+        # Кешуємо лише існуючі лічильники, щоб не пропустити доданий пізніше
+        if not self.__mongo(self.meters, "find_one", {"meter_id": meter_id}):
+            return False
+        self.__known_meters.set(meter_id, True)
+        return True
+
+    def __get_last_meters_data(self, meter_id: int):
+        last_meters_data = self.__last_meters_data.get(meter_id)
+        if last_meters_data is None:
+            last_meters_data = self.__mongo(
+                self.meters_data, "find_one",
+                {"meter_id": meter_id},
+                sort=[("date_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+            )
+            if not last_meters_data:
+                last_meters_data = self.__get_last_archived(meter_id)
+            if last_meters_data:
+                self.__last_meters_data.set(meter_id, last_meters_data)
+        return last_meters_data
+
+    def __get_last_archived(self, meter_id: int):
+        # Усі покази неактивного лічильника могли вже потрапити в архів
+        bucket = self.__mongo(self.meters_archive, "find_one", {"meter_id": meter_id},
+                              sort=[("month", pymongo.DESCENDING)])
+        if not bucket or not bucket["readings"]:
+            return None
+        return dict(max(bucket["readings"], key=lambda reading: (reading["date_time"], reading["_id"])), meter_id=meter_id)
+
+    def __get_profile(self, meter_id: int) -> MeterProfile:
+        profile = self.__profiles.get(meter_id)
+        if profile is None:
+            doc = self.__mongo(self.meter_profiles, "find_one", {"meter_id": meter_id})
+            profile = MeterProfile.from_doc(doc) if doc else MeterProfile(meter_id)
+            self.__profiles.set(meter_id, profile)
+        return profile
+
+    def __profile_update(self, profile: MeterProfile):
+        if self.__pending.profiles is not None:
+            self.__pending.profiles[profile.meter_id] = profile
+            return
+        self.__profile_save(profile.meter_id, profile)
+
+    def __profile_save(self, meter_id: int, profile: MeterProfile):
+        self.__mongo(self.meter_profiles, "update_one", {"meter_id": meter_id}, {"$set": profile.as_doc()},
+                     upsert=True)
+
+    def save_profiles(self, profiles: list[MeterProfile]):
+        """Замінює профілі лічильників, напр. перерахованими з усієї історії в manage.py scan-anomalies."""
+        self.__mongo(self.meter_profiles, "delete_many", {})
+        if profiles:
+            self.__mongo(self.meter_profiles, "insert_many", [profile.as_doc() for profile in profiles])
+        self.__profiles.clear()
+
     def __general_data_update(self, _id: str, data: dict | Mapping):
-        self.general_data.update_one(
+        if self.__pending.general_data is not None:
+            self.__pending.general_data[_id] = data
+            return
+
+        self.__mongo(
+            self.general_data, "update_one",
             {"_id": _id},
             {"$set": {"data": data}},
             upsert=True
         )
 
     def __general_data_get(self, _id: str):
-        result = self.general_data.find_one({"_id": _id})
+        result = self.__mongo(self.general_data, "find_one", {"_id": _id})
         if not result:
             return result
 
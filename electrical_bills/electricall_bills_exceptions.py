@@ -11,4 +11,19 @@ class NightTariffIsLowerThanZero(Exception):
     pass
 
 class DayTariffIsLowerThanZero(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class FakeMeterDataError(Exception):
+    pass
+
+class MeterAlreadyExistsError(Exception):
+    pass
+
+class TariffNotFoundError(Exception):
+    pass
+
+class PartialBulkWriteError(Exception):
+    def __init__(self, message: str, applied_readings: int):
+        super().__init__(message)
+        # Скільки перших показів пакета записано в meters_data
+        self.applied_readings = applied_readings
@@ -0,0 +1,114 @@
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import pymongo
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from pymongo.synchronous.database import Database
+
+from electricall_bills import LRUCache
+from electricall_bills_exceptions import PartialBulkWriteError
+
+_WINDOW_SIZE = 10_000
+_TTL_SECONDS = 24 * 60 * 60
+
+
+class _PendingRecords(threading.local):
+    # Записи разом з кількістю показів пакета, записаних до відповідного запиту включно
+    records: list[tuple[dict, int | None]] | None = None
+
+
+class IdempotencyStore:
+    """Результати вже виконаних запитів за ключем ідемпотентності.
+
+    Останні ключі тримаються в пам'яті, решта — в колекції processed_requests, записи якої
+    видаляє TTL-індекс.
+    """
+
+    def __init__(self, db: Database, window_size: int = _WINDOW_SIZE, ttl: int = _TTL_SECONDS):
+        self.processed_requests = db["processed_requests"]
+        self.ttl = ttl
+        self.__window = LRUCache(window_size)
+        self.__pending = _PendingRecords()
+
+    def create_indexes(self):
+        self.processed_requests.create_index([("created_at", pymongo.ASCENDING)], expireAfterSeconds=self.ttl)
+
+    def missing_indexes(self) -> list[str]:
+        """TTL-індекс, без якого processed_requests росте без обмеження, якщо його ще немає в базі."""
+        indexes = self.processed_requests.index_information().values()
+        if any([(field, int(order)) for field, order in index["key"]] == [("created_at", 1)]
+               and index.get("expireAfterSeconds") == self.ttl for index in indexes):
+            return []
+        return [f"{self.processed_requests.name}(created_at, expireAfterSeconds={self.ttl})"]
+
+    @contextmanager
+    def bulk(self):
+        """Відкладає запис результатів до успішного завершення пакету.
+
+        Якщо пакет показів записано частково, зберігаються ключі лише тих запитів, чиї покази вже записані.
+        """
+        if self.__pending.records is not None:
+            yield self
+            return
+
+        self.__pending.records = []
+        try:
+            yield self
+            self.__insert([record for record, _ in self.__pending.records])
+        except PartialBulkWriteError as e:
+            # Повтор застосованого запиту з тим самим ключем записав би показ удруге
+            applied = [record for record, readings in self.__pending.records
+                       if readings is not None and readings <= e.applied_readings]
+            self.__forget([record for record, readings in self.__pending.records
+                           if readings is None or readings > e.applied_readings])
+            try:
+                self.__insert(applied)
+            except PyMongoError:
+                # Ключі лишаються у вікні в пам'яті, тож повтор на цьому воркері все одно їх побачить
+                pass
+            raise
+        except Exception:
+            # Пакет не записано, тож повтор має виконатися заново
+            self.__forget([record for record, _ in self.__pending.records])
+            raise
+        finally:
+            self.__pending.records = None
+
+    def __insert(self, records: list[dict]):
+        if not records:
+            return
+        try:
+            self.processed_requests.insert_many(records, ordered=False)
+        except BulkWriteError:
+            pass
+
+    def __forget(self, records: list[dict]):
+        for record in records:
+            self.__window.pop(record["_id"])
+
+    def get(self, key: str) -> tuple[bool, dict | None]:
+        record = self.__window.get(key)
+        if record is None:
+            record = self.processed_requests.find_one({"_id": key})
+            if record is None:
+                return False, None
+            self.__window.set(key, record)
+        return True, record["result"]
+
+    def put(self, key: str, result: dict, readings: int | None = None):
+        """Зберігає результат запиту.
+
+        readings — кількість показів у буфері ElectricalBills.bulk() після виконання запиту.
+        """
+        # TTL-індекс рахує час в UTC
+        record = {"_id": key, "result": result, "created_at": datetime.now(timezone.utc)}
+        self.__window.set(key, record)
+        if self.__pending.records is not None:
+            self.__pending.records.append((record, readings))
+            return
+
+        try:
+            self.processed_requests.insert_one(record)
+        except DuplicateKeyError:
+            pass
@@ -0,0 +1,161 @@
+import argparse
+import json
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+import anomaly
+import config
+from electricall_bills import ElectricalBills
+from idempotency import IdempotencyStore
+from rebilling import RebillingJob
+from retention import RetentionJob, compact_readings
+
+
+def create_indexes(eb: ElectricalBills, args: argparse.Namespace):
+    eb.create_indexes()
+    IdempotencyStore(args.db).create_indexes()
+    print("Indexes are up to date")
+
+
+def rebuild_rollups(eb: ElectricalBills, _: argparse.Namespace):
+    eb.rebuild_rollups()
+    print(f"Rebuilt {eb.meters_daily.count_documents({})} daily and "
+          f"{eb.meters_monthly.count_documents({})} monthly rollups")
+
+
+def print_progress(state: dict, total: int):
+    print(f"{state['scanned']}/{total} readings scanned, {state['updated']} updated, "
+          f"cost delta {state['cost_delta']:.2f}")
+
+
+def rebill(eb: ElectricalBills, args: argparse.Namespace):
+    job = RebillingJob(eb, args.date_from, args.date_to, chunk_size=args.chunk_size)
+    state = job.run(resume=not args.restart, progress=print_progress)
+    print(f"Rebilled {state['updated']} of {state['scanned']} readings, cost delta {state['cost_delta']:.2f}")
+
+
+def correct_tariff(eb: ElectricalBills, args: argparse.Namespace):
+    if not eb.correct_tariff(args.tariff_id, args.day_tariff, args.night_tariff):
+        print(f"Tariff {args.tariff_id} not found")
+        return
+    # Обробники із закешованим старим тарифом нараховували б нові покази за старими цінами, тож їх
+    # повідомляємо одразу, а після перерахунку — ще раз, щоб web_app скинув сторінки з перерахованою вартістю
+    if args.notify:
+        notify_tariff_changed_or_warn()
+
+    # Раніше за створення тарифу показів з ним бути не може
+    tariff = eb.tariff_history.find_one({"_id": ObjectId(args.tariff_id)})
+    args.date_from, args.date_to = tariff["date_time"], None
+    rebill(eb, args)
+    if args.notify:
+        notify_tariff_changed_or_warn()
+
+
+def scan_anomalies(eb: ElectricalBills, args: argparse.Namespace):
+    found, profiles, scanned = anomaly.scan_history(eb.meters_data)
+    kinds = {}
+    for reading in found:
+        kinds[reading["kind"]] = kinds.get(reading["kind"], 0) + 1
+    print(f"Scanned {scanned} readings of {len(profiles)} meters, found {len(found)} anomalies {kinds}")
+
+    for reading in found[:args.limit]:
+        print(f"meter {reading['meter_id']} at {reading['date_time'].isoformat()}: {reading['kind']}, "
+              f"day usage {reading['day_usage']:.2f}, night usage {reading['night_usage']:.2f}")
+
+    if args.save_profiles:
+        eb.save_profiles(profiles)
+        print(f"Saved {len(profiles)} meter profiles")
+
+
+def archive_readings(eb: ElectricalBills, args: argparse.Namespace):
+    cutoff = datetime.now() - timedelta(days=args.older_than)
+    state = RetentionJob(eb, cutoff, chunk_size=args.chunk_size).run(
+        progress=lambda state, total: print(f"{state['moved']}/{total} readings archived"))
+    print(f"Archived {state['moved']} readings older than {cutoff.isoformat()}")
+
+
+def compact(eb: ElectricalBills, args: argparse.Namespace):
+    print(f"Compacted {compact_readings(eb, args.chunk_size)} readings")
+
+
+def notify_tariff_changed():
+    """Повідомляє запущені обробники та web_app, щоб ті скинули закешований поточний тариф."""
+    import pika
+
+    connection = pika.BlockingConnection(config.amqp_parameters())
+    try:
+        channel = connection.channel()
+        channel.exchange_declare(exchange="electrical_bills", exchange_type="direct")
+        channel.basic_publish(exchange="electrical_bills", routing_key="electrical.bills.events",
+                              body=json.dumps({"event": "tariff_changed"}).encode())
+    finally:
+        connection.close()
+
+
+def notify_tariff_changed_or_warn():
+    try:
+        notify_tariff_changed()
+    except Exception as e:
+        print(f"Failed to publish tariff_changed ({e}); restart running handlers so they reload the tariff")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Службові команди electrical_bills")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("create-indexes", help="створити індекси колекцій; запускати перед стартом обробників") \
+        .set_defaults(handler=create_indexes)
+
+    commands.add_parser("rebuild-rollups", help="перерахувати денні та місячні підсумки з meters_data та архіву") \
+        .set_defaults(handler=rebuild_rollups)
+
+    rebill_parser = commands.add_parser("rebill", help="перерахувати вартість показів за історією тарифів")
+    rebill_parser.add_argument("--from", dest="date_from", type=datetime.fromisoformat, default=None,
+                               help="початок періоду, ISO 8601")
+    rebill_parser.add_argument("--to", dest="date_to", type=datetime.fromisoformat, default=None,
+                               help="кінець періоду (не включно), ISO 8601")
+    rebill_parser.set_defaults(handler=rebill)
+
+    correct_parser = commands.add_parser("correct-tariff",
+                                         help="виправити ціни тарифу та перерахувати вартість показів з ним")
+    correct_parser.add_argument("tariff_id")
+    correct_parser.add_argument("day_tariff", type=float)
+    correct_parser.add_argument("night_tariff", type=float)
+    correct_parser.add_argument("--notify", action=argparse.BooleanOptionalAction, default=True,
+                                help="надіслати подію tariff_changed запущеним обробникам через RabbitMQ "
+                                     "(--no-notify, лише якщо обробники зупинені)")
+    correct_parser.set_defaults(handler=correct_tariff)
+
+    scan_parser = commands.add_parser("scan-anomalies",
+                                      help="знайти відкати та стрибки показів у всій історії meters_data")
+    scan_parser.add_argument("--limit", type=int, default=20, help="скільки аномальних показів вивести")
+    scan_parser.add_argument("--save-profiles", action="store_true",
+                             help="замінити профілі лічильників обрахованими з історії")
+    scan_parser.set_defaults(handler=scan_anomalies)
+
+    archive_parser = commands.add_parser("archive-readings",
+                                         help="перенести старі покази в помісячні бакети meters_archive")
+    archive_parser.add_argument("--older-than", type=int, default=config.READINGS_RETENTION_DAYS,
+                                help="вік показів у днях (за замовчуванням READINGS_RETENTION_DAYS)")
+    archive_parser.set_defaults(handler=archive_readings)
+
+    compact_parser = commands.add_parser("compact-readings",
+                                         help="замінити вбудовані тарифи у старих показах на tariff_id")
+    compact_parser.set_defaults(handler=compact)
+
+    for subparser in (archive_parser, compact_parser):
+        subparser.add_argument("--chunk-size", type=int, default=5000)
+
+    for subparser in (rebill_parser, correct_parser):
+        subparser.add_argument("--chunk-size", type=int, default=5000)
+        subparser.add_argument("--restart", action="store_true",
+                               help="почати спочатку замість продовження перерваного запуску")
+
+    args = parser.parse_args()
+    args.db = config.database(config.mongo_client("manage"))
+    args.handler(ElectricalBills(args.db), args)
+
+
+if __name__ == "__main__":
+    main()
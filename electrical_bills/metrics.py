@@ -0,0 +1,231 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        return [f"{self.name}{self._format_labels(key)} {value}"]
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Лічильники по кошиках (не кумулятивні), сума, кількість
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        counts, total, count = value[0][:], value[1], value[2]
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += bucket_count
+            le = f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+        lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Обробник
+REQUESTS = REGISTRY.register(Counter(
+    "electrical_bills_requests_total", "Processed update requests", ("type", "status")))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "electrical_bills_request_seconds", "Time to validate and execute an update request", ("type",)))
+QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "electrical_bills_queue_wait_seconds", "Time a request spent in RabbitMQ before processing"))
+VALIDATION_SECONDS = REGISTRY.register(Histogram(
+    "electrical_bills_validation_seconds", "Time spent in pydantic request validation"))
+VALIDATION_FAILURES = REGISTRY.register(Counter(
+    "electrical_bills_validation_failures_total", "Requests rejected by validation"))
+EXPIRED_REQUESTS = REGISTRY.register(Counter(
+    "electrical_bills_expired_requests_total", "Requests dropped because their deadline passed in the queue"))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "electrical_bills_handler_errors_total", "Errors while publishing replies or events", ("stage",)))
+
+# ElectricalBills
+MONGO_SECONDS = REGISTRY.register(Histogram(
+    "electrical_bills_mongo_seconds", "Duration of MongoDB calls made by ElectricalBills",
+    ("collection", "operation")))
+FAKE_READINGS = REGISTRY.register(Counter(
+    "electrical_bills_fake_readings_total", "Readings that were rolled back or spiked and corrected"))
+READING_ANOMALIES = REGISTRY.register(Counter(
+    "electrical_bills_reading_anomalies_total", "Corrected readings by anomaly kind", ("kind",)))
+
+# Пули з'єднань MongoDB, див. config.PoolStatsListener
+MONGO_POOL_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "electrical_bills_mongo_pool_wait_seconds", "Time spent waiting to check a connection out of the pool",
+    ("client",)))
+MONGO_POOL_CHECKED_OUT = REGISTRY.register(Gauge(
+    "electrical_bills_mongo_pool_checked_out", "Connections currently checked out of the pool", ("client",)))
+MONGO_POOL_CONNECTIONS = REGISTRY.register(Gauge(
+    "electrical_bills_mongo_pool_connections", "Open pool connections", ("client",)))
+MONGO_POOL_CHECKOUT_FAILURES = REGISTRY.register(Counter(
+    "electrical_bills_mongo_pool_checkout_failures_total", "Failed connection checkouts", ("client", "reason")))
+
+# web_app
+RPC_SECONDS = REGISTRY.register(Histogram(
+    "electrical_bills_rpc_seconds", "Round-trip time of web_app requests to the handler", ("type",)))
+RPC_IN_FLIGHT = REGISTRY.register(Gauge(
+    "electrical_bills_rpc_in_flight", "web_app requests waiting for a handler reply"))
+RPC_TIMEOUTS = REGISTRY.register(Counter(
+    "electrical_bills_rpc_timeouts_total", "web_app requests that got no reply in time", ("type",)))
+RPC_REJECTED = REGISTRY.register(Counter(
+    "electrical_bills_rpc_rejected_total", "web_app requests rejected with 503 before reaching the handler",
+    ("reason",)))
+UPDATES_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "electrical_bills_updates_queue_depth", "Last observed number of messages in an updates queue", ("queue",)))
+
+
+REQUEST_TYPES = ("add_meter_data", "add_meter_data_batch", "add_meter", "add_tariff", "set_tariff")
+
+
+def request_type(data) -> str:
+    if not isinstance(data, dict):
+        return "unknown"
+    if data.get("type") in REQUEST_TYPES:
+        return data["type"]
+    # Старі повідомлення без type
+    if "readings" in data:
+        return "add_meter_data_batch"
+    if "day" in data:
+        return "add_meter_data"
+    if "day_tariff" in data:
+        return "add_tariff"
+    if "tariff_id" in data:
+        return "set_tariff"
+    if "meter_id" in data:
+        return "add_meter"
+    return "unknown"
+
+
+# Воркер готовий брати повідомлення: прогрів завершено і з'єднання з RabbitMQ відкрите
+READY = threading.Event()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        match self.path.split("?", 1)[0]:
+            case "/metrics":
+                self.__respond(200, REGISTRY.render(), CONTENT_TYPE)
+            case "/healthz":
+                self.__respond(200, "ok")
+            case "/readyz":
+                if READY.is_set():
+                    self.__respond(200, "ready")
+                else:
+                    self.__respond(503, "not ready")
+            case _:
+                self.send_error(404)
+
+    def __respond(self, status: int, text: str, content_type: str = "text/plain; charset=utf-8"):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
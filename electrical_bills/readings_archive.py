@@ -0,0 +1,42 @@
+from datetime import datetime
+
+# Поля показу, що зберігаються в бакеті архіву; meter_id і місяць — у самому бакеті
+READING_FIELDS = ("_id", "date_time", "day", "night", "day_usage", "night_usage", "cost", "tariff_id")
+
+
+def tariff_id(doc: dict):
+    """Id тарифу показу; старі покази містять вбудований документ тарифу замість посилання."""
+    return doc.get("tariff_id") or doc.get("tariff", {}).get("_id")
+
+
+def compact_reading(doc: dict) -> dict:
+    """Показ у компактному форматі бакета: лише id тарифу, без meter_id."""
+    reading = {field: doc[field] for field in READING_FIELDS if field in doc}
+    reading["tariff_id"] = tariff_id(doc)
+    return reading
+
+
+def bucket_filter(meter_id: int | None = None, date_from: datetime | None = None,
+                  date_to: datetime | None = None) -> dict:
+    """Відбір бакетів, у яких можуть бути покази лічильника за період, до розгортання масивів."""
+    query = {}
+    if meter_id is not None:
+        query["meter_id"] = meter_id
+    if date_from:
+        query["last"] = {"$gte": date_from}
+    if date_to:
+        query["first"] = {"$lte": date_to}
+    return query
+
+
+def archive_pipeline(query: dict, sort: list, limit: int | None = None, buckets: dict | None = None) -> list:
+    """Aggregation-пайплайн, що розгортає бакети meters_archive у документи того ж вигляду, що й у meters_data.
+
+    query і sort задаються за полями показу, як для meters_data.find.
+    """
+    pipeline = [{"$match": buckets or {}}, {"$unwind": "$readings"},
+                {"$project": {"meter_id": 1, **{field: f"$readings.{field}" for field in READING_FIELDS}}},
+                {"$match": query}, {"$sort": dict(sort)}]
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    return pipeline
@@ -0,0 +1,171 @@
+import argparse
+import csv
+import io
+import itertools
+from collections.abc import Iterable, Iterator, Mapping
+from datetime import datetime
+
+import pymongo
+
+import config
+from readings_archive import READING_FIELDS, bucket_filter, tariff_id
+
+BATCH_SIZE = 5_000
+ROW_GROUP_SIZE = 100_000
+
+COLUMNS = ("meter_id", "date_time", "day", "night", "day_usage", "night_usage", "day_tariff", "night_tariff", "cost")
+PROJECTION = {"_id": 0, "meter_id": 1, "date_time": 1, "day": 1, "night": 1, "day_usage": 1, "night_usage": 1,
+              "tariff_id": 1, "tariff._id": 1, "cost": 1}
+TARIFF_PROJECTION = {"day_tariff": 1, "night_tariff": 1}
+# Порядок, що йде за індексами (date_time, _id) та (meter_id, date_time, _id)
+SORT = [("date_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+# Бакети архіву читаються за унікальним індексом (meter_id, month), тож сортування не блокує потік
+ARCHIVE_SORT = [("meter_id", pymongo.ASCENDING), ("month", pymongo.ASCENDING)]
+ARCHIVE_PROJECTION = {"meter_id": 1, "readings": 1}
+
+
+def export_query(meter_id: int | None = None, date_from: datetime | None = None,
+                 date_to: datetime | None = None) -> dict:
+    query = {}
+    if meter_id is not None:
+        query["meter_id"] = meter_id
+    date_time = {}
+    if date_from:
+        date_time["$gte"] = date_from
+    if date_to:
+        date_time["$lt"] = date_to
+    if date_time:
+        query["date_time"] = date_time
+    return query
+
+
+def archive_batch_size(batch_size: int) -> int:
+    # Бакет — це місяць показів лічильника, тож пакет курсора з бакетів менший за batch_size показів
+    return max(1, batch_size // 100)
+
+
+def bucket_rows(bucket: dict, date_from: datetime | None = None, date_to: datetime | None = None) -> list[dict]:
+    """Покази бакета за період у порядку часу й у вигляді документів meters_data з PROJECTION.
+
+    Бакети йдуть за ARCHIVE_SORT, тож архів експортується за лічильником, а в межах лічильника — за часом,
+    і в пам'яті одночасно лише один бакет.
+    """
+    readings = sorted(bucket["readings"], key=lambda reading: (reading["date_time"], reading["_id"]))
+    return [dict({field: reading[field] for field in READING_FIELDS if field != "_id" and field in reading},
+                 meter_id=bucket["meter_id"])
+            for reading in readings
+            if (not date_from or reading["date_time"] >= date_from) and (not date_to or reading["date_time"] < date_to)]
+
+
+def iter_archive(buckets: Iterable[dict], date_from: datetime | None = None,
+                 date_to: datetime | None = None) -> Iterator[dict]:
+    for bucket in buckets:
+        yield from bucket_rows(bucket, date_from, date_to)
+
+
+def export_row(doc: dict, tariffs: Mapping = {}) -> tuple:
+    # Старі покази не мають збереженого споживання — такі клітинки лишаються порожніми
+    tariff = tariffs.get(tariff_id(doc), {})
+    return (doc["meter_id"], doc["date_time"], doc["day"], doc["night"], doc.get("day_usage"),
+            doc.get("night_usage"), tariff.get("day_tariff"), tariff.get("night_tariff"), doc["cost"])
+
+
+def csv_chunk(docs: Iterable[dict], header: bool = False, tariffs: Mapping = {}) -> str:
+    """Рядки CSV для частини документів, за потреби з заголовком; ціни беруться з tariffs за id тарифу."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(COLUMNS)
+    for doc in docs:
+        row = export_row(doc, tariffs)
+        writer.writerow((row[0], row[1].isoformat(), *row[2:]))
+    return buffer.getvalue()
+
+
+def iter_chunks(docs: Iterable[dict], size: int) -> Iterator[list[dict]]:
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_columnar(docs: Iterable[dict], path: str, fmt: str = "parquet", row_group_size: int = ROW_GROUP_SIZE,
+                   tariffs: Mapping = {}) -> int:
+    """Пише покази у Parquet або Arrow IPC групами рядків, не тримаючи весь результат у пам'яті."""
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Columnar export requires pyarrow: pip install pyarrow") from None
+
+    schema = pa.schema([
+        ("meter_id", pa.int64()), ("date_time", pa.timestamp("ms")),
+        ("day", pa.float64()), ("night", pa.float64()),
+        ("day_usage", pa.float64()), ("night_usage", pa.float64()),
+        ("day_tariff", pa.float64()), ("night_tariff", pa.float64()),
+        ("cost", pa.float64()),
+    ])
+    if fmt == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+    elif fmt == "arrow":
+        writer = pyarrow.ipc.new_file(path, schema)
+    else:
+        raise ValueError(f"Unsupported format {fmt}")
+
+    rows = 0
+    with writer:
+        for chunk in iter_chunks(docs, row_group_size):
+            columns = list(zip(*(export_row(doc, tariffs) for doc in chunk)))
+            writer.write_table(pa.Table.from_arrays([pa.array(column, type=field.type)
+                                                     for column, field in zip(columns, schema)], schema=schema))
+            rows += len(chunk)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Експорт показів лічильників у CSV, Parquet або Arrow")
+    parser.add_argument("file")
+    parser.add_argument("--format", choices=("csv", "parquet", "arrow"), default=None,
+                        help="формат файлу (за замовчуванням визначається з розширення)")
+    parser.add_argument("--meter-id", type=int, default=None)
+    parser.add_argument("--from", dest="date_from", type=datetime.fromisoformat, default=None,
+                        help="початок періоду, ISO 8601")
+    parser.add_argument("--to", dest="date_to", type=datetime.fromisoformat, default=None,
+                        help="кінець періоду (не включно), ISO 8601")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="розмір пакету курсора MongoDB")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE)
+    args = parser.parse_args()
+
+    fmt = args.format or {"parquet": "parquet", "arrow": "arrow", "feather": "arrow"}.get(
+        args.file.rsplit(".", 1)[-1], "csv")
+
+    db = config.database(config.mongo_client("export"), config.WEB_READ_PREFERENCE)
+    tariffs = {tariff["_id"]: tariff for tariff in db["tariff_history"].find({}, TARIFF_PROJECTION)}
+    # Архівні покази старші за всі покази в meters_data, тож вони йдуть першими
+    docs = itertools.chain(
+        iter_archive(db["meters_archive"].find(bucket_filter(args.meter_id, args.date_from, args.date_to),
+                                               ARCHIVE_PROJECTION, sort=ARCHIVE_SORT,
+                                               batch_size=archive_batch_size(args.batch_size)),
+                     args.date_from, args.date_to),
+        db["meters_data"].find(export_query(args.meter_id, args.date_from, args.date_to), PROJECTION, sort=SORT,
+                               batch_size=args.batch_size))
+
+    if fmt == "csv":
+        rows = 0
+        with open(args.file, "w", encoding="utf-8", newline="") as f:
+            f.write(csv_chunk([], header=True))
+            for chunk in iter_chunks(docs, args.batch_size):
+                f.write(csv_chunk(chunk, tariffs=tariffs))
+                rows += len(chunk)
+    else:
+        rows = write_columnar(docs, args.file, fmt, args.row_group_size, tariffs)
+    print(f"Exported {rows} readings to {args.file}")
+
+
+if __name__ == "__main__":
+    main()
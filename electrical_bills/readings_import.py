@@ -0,0 +1,287 @@
+import argparse
+import csv
+import json
+import time
+import uuid
+from collections.abc import Callable, Iterable, Iterator
+
+import pika
+import pika.exceptions
+from pydantic import ValidationError
+
+import config
+from electricall_bills import ElectricalBills
+from electrical_bills_updates_validator import ActionRequest, AddMeterDataBatchRequest, AddMeterDataRequest, \
+    FAKE_METER_DATA_MESSAGE, execute_update
+from electricall_bills_exceptions import PartialBulkWriteError
+
+BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+# Скільки лічильників перелічується в одній події про імпортовані покази
+EVENT_METER_IDS = 1000
+
+
+class ReadingsParser:
+    """Розбір CSV (з заголовком meter_id,day,night) або JSONL у AddMeterDataRequest."""
+
+    def __init__(self, fmt: str):
+        if fmt not in ("csv", "jsonl"):
+            raise ValueError(f"Unsupported format {fmt}")
+        self.fmt = fmt
+        self.header: list[str] | None = None
+        # Рядки запису CSV, поле в лапках якого ще не закрите
+        self.pending: list[str] = []
+
+    def parse_line(self, line: str) -> AddMeterDataRequest | str | None:
+        """Повертає модель, текст помилки або None для заголовка, порожніх рядків і незавершеного запису CSV.
+
+        Для потоку рядків без файлу: запис CSV, поле в лапках якого переходить на наступний рядок,
+        накопичується, доки кількість лапок не стане парною.
+        """
+        if self.fmt == "jsonl":
+            line = line.strip()
+            if not line:
+                return None
+            try:
+                return AddMeterDataRequest.model_validate(json.loads(line))
+            except (ValueError, ValidationError) as e:
+                return str(e)
+
+        self.pending.append(line.rstrip("\r\n") + "\n")
+        if sum(part.count('"') for part in self.pending) % 2:
+            return None
+        lines, self.pending = self.pending, []
+        try:
+            return self.parse_row(next(csv.reader(lines), []))
+        except csv.Error as e:
+            return str(e)
+
+    def parse_row(self, values: list[str]) -> AddMeterDataRequest | str | None:
+        """Те саме для вже розібраного запису CSV."""
+        if not any(value.strip() for value in values):
+            return None
+        if self.header is None:
+            self.header = [value.strip() for value in values]
+            return None
+        try:
+            return AddMeterDataRequest.model_validate(dict(zip(self.header, values)))
+        except ValidationError as e:
+            return str(e)
+
+
+class ImportSummary:
+    def __init__(self):
+        self.total = 0
+        self.accepted = 0
+        self.corrected = 0
+        self.failed = 0
+        self.errors: list[dict] = []
+
+    def add(self, row: int, error: str | None):
+        self.total += 1
+        # Показ зі скоригованим споживанням записано, тож він прийнятий, хоч обробник і повертає повідомлення
+        if not error or error == FAKE_METER_DATA_MESSAGE:
+            self.accepted += 1
+            self.corrected += bool(error)
+            return
+
+        self.failed += 1
+        # Кількість помилок у звіті обмежена, щоб зіпсований файл не з'їв пам'ять
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "error": error})
+
+    def as_dict(self) -> dict:
+        return {"total": self.total, "accepted": self.accepted, "corrected": self.corrected, "failed": self.failed,
+                "errors": self.errors}
+
+
+def iter_readings(lines: Iterable[str], fmt: str) -> Iterator[tuple[int, AddMeterDataRequest | str]]:
+    """Номер рядка й результат розбору; для CSV номер — останній рядок запису у файлі."""
+    parser = ReadingsParser(fmt)
+    if fmt == "jsonl":
+        for row, line in enumerate(lines, start=1):
+            result = parser.parse_line(line)
+            if result is not None:
+                yield row, result
+        return
+
+    # csv.reader сам дочитує наступні рядки файлу, якщо поле в лапках містить перенесення рядка
+    reader = csv.reader(lines)
+    while True:
+        try:
+            result = parser.parse_row(next(reader))
+        except StopIteration:
+            return
+        except csv.Error as e:
+            result = str(e)
+        if result is not None:
+            yield reader.line_num, result
+
+
+def import_direct(eb: ElectricalBills, lines: Iterable[str], fmt: str, batch_size: int = BATCH_SIZE,
+                  on_written: Callable[[list[int]], None] | None = None) -> dict:
+    """Записує покази напряму через ElectricalBills, по bulk_write на кожні batch_size рядків.
+
+    on_written отримує лічильники, покази яких записано пакетом, напр. щоб повідомити про них обробники й web_app.
+    """
+    summary = ImportSummary()
+    batch: list[tuple[int, AddMeterDataRequest]] = []
+
+    def flush():
+        # Рядки вже провалідовані парсером, тож запит збирається з готових моделей
+        results = execute_update(eb, ActionRequest(data=AddMeterDataBatchRequest(readings=[r for _, r in batch])))
+        if not isinstance(results, list):
+            # Частково записаний пакет теж міг змінити покази будь-якого зі своїх лічильників
+            partial = isinstance(results, PartialBulkWriteError)
+            written = {reading.meter_id for _, reading in batch} if partial else set()
+            results = [results] * len(batch)
+        else:
+            written = {reading.meter_id for (_, reading), error in zip(batch, results)
+                       if not error or str(error) == FAKE_METER_DATA_MESSAGE}
+        for (row, _), error in zip(batch, results):
+            summary.add(row, str(error) if error else None)
+        batch.clear()
+        if on_written and written:
+            on_written(sorted(written))
+
+    for row, reading in iter_readings(lines, fmt):
+        if isinstance(reading, str):
+            summary.add(row, reading)
+            continue
+        batch.append((row, reading))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    return summary.as_dict()
+
+
+class ReadingsPublisher:
+    """Публікує пакети показів у чергу оновлень і чекає на відповідь обробника."""
+
+    def __init__(self, shards: int = 1, parameters: pika.URLParameters | None = None):
+        self.shards = shards
+        self.connection = pika.BlockingConnection(parameters or config.amqp_parameters())
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange="electrical_bills", exchange_type="direct")
+        self.reply_queue = self.channel.queue_declare("", exclusive=True).method.queue
+        self.channel.basic_consume(queue=self.reply_queue, on_message_callback=self.__on_reply, auto_ack=True)
+        self.replies: dict[str, list] = {}
+
+    def __on_reply(self, ch, method, properties, body):
+        self.replies[properties.correlation_id] = json.loads(body).get("response")
+
+    def routing_key(self, meter_id: int) -> str:
+        if self.shards <= 1:
+            return "electrical.bills.updates"
+        return f"electrical.bills.updates.{meter_id % self.shards}"
+
+    def publish(self, routing_key: str, readings: list[AddMeterDataRequest], timeout: float = 60) -> list:
+        correlation_id = str(uuid.uuid4())
+        self.channel.basic_publish(
+            exchange="electrical_bills",
+            routing_key=routing_key,
+            properties=pika.BasicProperties(reply_to=self.reply_queue, correlation_id=correlation_id),
+            body=ActionRequest(data=AddMeterDataBatchRequest(readings=readings)).model_dump_json().encode()
+        )
+        deadline = time.monotonic() + timeout
+        while correlation_id not in self.replies and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.1)
+
+        response = self.replies.pop(correlation_id, "Обробник не відповів вчасно.")
+        if not isinstance(response, list):
+            return [response] * len(readings)
+        return response
+
+    def close(self):
+        self.connection.close()
+
+
+class ImportEvents:
+    """Події про покази, записані імпортом --direct в обхід обробника.
+
+    readings_added оновлює кеш сторінок і живі оновлення web_app, а readings_imported змушує обробники
+    скинути закешовані останні покази й профілі цих лічильників.
+    """
+
+    def __init__(self, parameters: pika.URLParameters | None = None):
+        self.connection = pika.BlockingConnection(parameters or config.amqp_parameters())
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange="electrical_bills", exchange_type="direct")
+
+    def publish(self, meter_ids: list[int]):
+        for start in range(0, len(meter_ids), EVENT_METER_IDS):
+            chunk = meter_ids[start:start + EVENT_METER_IDS]
+            # Обробники скидають кеш раніше, ніж web_app прочитає нові покази
+            for event in ("readings_imported", "readings_added"):
+                self.channel.basic_publish(exchange="electrical_bills", routing_key="electrical.bills.events",
+                                           body=json.dumps({"event": event, "meter_ids": chunk}).encode())
+
+    def close(self):
+        self.connection.close()
+
+
+def import_via_queue(publisher: ReadingsPublisher, lines: Iterable[str], fmt: str,
+                     batch_size: int = BATCH_SIZE) -> dict:
+    """Групує покази за шардами й публікує їх пакетами, зберігаючи порядок для кожного лічильника."""
+    summary = ImportSummary()
+    batches: dict[str, list[tuple[int, AddMeterDataRequest]]] = {}
+
+    def flush(routing_key: str):
+        batch = batches.pop(routing_key)
+        results = publisher.publish(routing_key, [reading for _, reading in batch])
+        for (row, _), error in zip(batch, results):
+            summary.add(row, error)
+
+    for row, reading in iter_readings(lines, fmt):
+        if isinstance(reading, str):
+            summary.add(row, reading)
+            continue
+        routing_key = publisher.routing_key(reading.meter_id)
+        batches.setdefault(routing_key, []).append((row, reading))
+        if len(batches[routing_key]) >= batch_size:
+            flush(routing_key)
+    for routing_key in list(batches):
+        flush(routing_key)
+
+    return summary.as_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Імпорт показів лічильників з CSV або JSONL файлу")
+    parser.add_argument("file")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default=None,
+                        help="формат файлу (за замовчуванням визначається з розширення)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--direct", action="store_true",
+                        help="писати напряму в MongoDB через ElectricalBills замість черги")
+    parser.add_argument("--shards", type=int, default=1, help="кількість шардів обробника")
+    args = parser.parse_args()
+
+    fmt = args.format or ("jsonl" if args.file.endswith((".jsonl", ".ndjson")) else "csv")
+
+    with open(args.file, encoding="utf-8", newline="") as lines:
+        if args.direct:
+            db = config.database(config.mongo_client("import"))
+            try:
+                events = ImportEvents()
+            except pika.exceptions.AMQPConnectionError as e:
+                # Без RabbitMQ запущені обробники й web_app не отримали б подій, тож імпорт не починається
+                raise SystemExit(f"Can't connect to RabbitMQ to notify handlers about imported readings: {e}")
+            try:
+                summary = import_direct(ElectricalBills(db), lines, fmt, args.batch_size, events.publish)
+            finally:
+                events.close()
+        else:
+            publisher = ReadingsPublisher(args.shards)
+            try:
+                summary = import_via_queue(publisher, lines, fmt, args.batch_size)
+            finally:
+                publisher.close()
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+from collections.abc import Callable
+from datetime import datetime
+
+import numpy as np
+import pymongo
+from pymongo import UpdateOne
+
+from electricall_bills import ElectricalBills
+from readings_archive import archive_pipeline, bucket_filter, compact_reading, tariff_id
+from tariff_timeline import TariffTimeline
+
+_CHUNK_SIZE = 5_000
+_STATE_ID = "rebilling"
+# Порядок обходу, у якому збережено позицію стану: архів, потім meters_data, обидва за лічильником і часом
+_ORDER = "archive,meter_time"
+_PROJECTION = {"meter_id": 1, "day": 1, "night": 1, "day_usage": 1, "night_usage": 1, "cost": 1,
+               "date_time": 1, "tariff_id": 1, "tariff._id": 1}
+
+
+class RebillingJob:
+    """Перерахунок вартості показів за TariffTimeline.
+
+    Спершу частинами бакетів перераховується архів, потім так само meters_data; обидва рівні читаються
+    за лічильником, а в межах лічильника — за часом. Вартість частини рахується векторно, а змінені покази
+    та денні й місячні підсумки записуються пакетними оновленнями. Позиція зберігається в general_data
+    після кожної частини, тож перерваний запуск продовжується з неї.
+    """
+
+    def __init__(self, eb: ElectricalBills, date_from: datetime | None = None, date_to: datetime | None = None,
+                 chunk_size: int = _CHUNK_SIZE, timeline: TariffTimeline | None = None):
+        self.eb = eb
+        self.date_from = date_from
+        self.date_to = date_to
+        self.chunk_size = chunk_size
+        self.timeline = timeline or TariffTimeline.load(eb)
+
+    def run(self, resume: bool = True, progress: Callable[[dict, int], None] | None = None) -> dict:
+        state = self.__load_state() if resume else None
+        if state is None:
+            state = {"date_from": self.date_from, "date_to": self.date_to, "order": _ORDER, "archive_after": None,
+                     "after": None, "scanned": 0, "updated": 0, "cost_delta": 0.0, "finished": False}
+        total = self.eb.meters_data.count_documents(self.__range_query()) + self.__archived_count()
+
+        # Архів старший за meters_data, тож спершу перераховується він. Обидва рівні обходяться
+        # за лічильником, а в межах лічильника — за часом, щоб попередній показ переносився з частини в частину
+        self.__previous = None
+        while True:
+            buckets = list(self.eb.meters_archive.find(
+                self.__buckets_query(state["archive_after"]),
+                sort=[("meter_id", pymongo.ASCENDING), ("month", pymongo.ASCENDING)],
+                # Бакет — це місяць показів лічильника, тож частина з бакетів менша за chunk_size показів
+                limit=max(1, self.chunk_size // 100)
+            ))
+            if not buckets:
+                break
+
+            scanned, updated, cost_delta = self.__rebill_buckets(buckets)
+            state["archive_after"] = [buckets[-1]["meter_id"], buckets[-1]["month"]]
+            state["scanned"] += scanned
+            state["updated"] += updated
+            state["cost_delta"] += cost_delta
+            self.__save_state(state)
+            if progress:
+                progress(state, total)
+
+        self.__previous = None
+        while True:
+            # Зворотний порядок індексу (meter_id, date_time, _id)
+            chunk = list(self.eb.meters_data.find(
+                self.__chunk_query(state["after"]), _PROJECTION,
+                sort=[("meter_id", pymongo.DESCENDING), ("date_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                limit=self.chunk_size
+            ))
+            if not chunk:
+                break
+
+            updated, cost_delta = self.__rebill_chunk(chunk)
+            state["after"] = [chunk[-1]["meter_id"], chunk[-1]["date_time"], chunk[-1]["_id"]]
+            state["scanned"] += len(chunk)
+            state["updated"] += updated
+            state["cost_delta"] += cost_delta
+            self.__save_state(state)
+            if progress:
+                progress(state, total)
+
+        state["finished"] = True
+        self.__save_state(state)
+        return state
+
+    def __rebill_chunk(self, chunk: list[dict]) -> tuple[int, float]:
+        usages = []
+        for doc in chunk:
+            usages.append(self.__usage(doc))
+            self.__previous = doc
+        changed, cost_delta = self.__reprice(chunk, usages)
+        rollups = {self.eb.meters_daily: {}, self.eb.meters_monthly: {}}
+        updates = []
+        for i, fields in changed.items():
+            # Разом з перерахунком старі покази переходять на посилання на тариф
+            updates.append(UpdateOne({"_id": chunk[i]["_id"]}, {"$set": fields, "$unset": {"tariff": ""}}))
+            self.__add_rollup_delta(rollups, chunk[i], float(cost_delta[i]))
+
+        if updates:
+            self.eb.meters_data.bulk_write(updates, ordered=False)
+        self.__write_rollups(rollups)
+        return len(updates), float(cost_delta.sum())
+
+    def __rebill_buckets(self, buckets: list[dict]) -> tuple[int, int, float]:
+        chunk, usages, positions = [], [], []
+        for bucket in buckets:
+            readings = sorted(bucket["readings"], key=lambda reading: (reading["date_time"], reading["_id"]))
+            for position, reading in enumerate(readings):
+                reading = dict(reading, meter_id=bucket["meter_id"])
+                # Покази поза періодом не перераховуються, але слугують попередніми для наступних
+                if self.__in_range(reading["date_time"]):
+                    chunk.append(reading)
+                    usages.append(self.__usage(reading))
+                    positions.append((bucket, readings, position))
+                self.__previous = reading
+        if not chunk:
+            return 0, 0, 0.0
+
+        changed, cost_delta = self.__reprice(chunk, usages)
+        rollups = {self.eb.meters_daily: {}, self.eb.meters_monthly: {}}
+        touched = {}
+        for i, fields in changed.items():
+            bucket, readings, position = positions[i]
+            readings[position] = compact_reading(dict(readings[position], **fields))
+            touched[bucket["_id"]] = readings
+            self.__add_rollup_delta(rollups, chunk[i], float(cost_delta[i]))
+
+        if touched:
+            self.eb.meters_archive.bulk_write([UpdateOne({"_id": _id}, {"$set": {"readings": readings}})
+                                               for _id, readings in touched.items()], ordered=False)
+        self.__write_rollups(rollups)
+        return len(chunk), len(changed), float(cost_delta.sum())
+
+    def __reprice(self, chunk: list[dict], usages: list[tuple[float, float]]) -> tuple[dict[int, dict], np.ndarray]:
+        """Нові поля змінених показів за їх індексом у chunk та різниця вартості кожного показу."""
+        tariffs = self.timeline.resolve([doc["date_time"] for doc in chunk], [tariff_id(doc) for doc in chunk])
+
+        # Покази з невідомим тарифом залишаємо як є
+        known = np.array([tariff is not None for tariff in tariffs])
+        day_usage = np.array([usage[0] for usage in usages], dtype=np.float64)
+        night_usage = np.array([usage[1] for usage in usages], dtype=np.float64)
+        day_tariff = np.array([tariff["day_tariff"] if tariff else 0.0 for tariff in tariffs], dtype=np.float64)
+        night_tariff = np.array([tariff["night_tariff"] if tariff else 0.0 for tariff in tariffs], dtype=np.float64)
+        old_cost = np.array([doc["cost"] for doc in chunk], dtype=np.float64)
+
+        new_cost = day_tariff * day_usage + night_tariff * night_usage
+        cost_delta = np.where(known, new_cost - old_cost, 0.0)
+        stale = np.array([tariff is not None and ("tariff_id" not in doc or doc["tariff_id"] != tariff["_id"])
+                          or "day_usage" not in doc for doc, tariff in zip(chunk, tariffs)])
+        changed = known & (stale | ~np.isclose(new_cost, old_cost))
+
+        return {i: {"tariff_id": tariffs[i]["_id"], "cost": float(new_cost[i]), "day_usage": float(day_usage[i]),
+                    "night_usage": float(night_usage[i])}
+                for i in np.flatnonzero(changed).tolist()}, cost_delta
+
+    def __add_rollup_delta(self, rollups: dict, doc: dict, cost_delta: float):
+        if not cost_delta:
+            return
+        for collection, key in ((self.eb.meters_daily, ("date", doc["date_time"].strftime("%Y-%m-%d"))),
+                                (self.eb.meters_monthly, ("month", doc["date_time"].strftime("%Y-%m")))):
+            key = (doc["meter_id"], *key)
+            rollups[collection][key] = rollups[collection].get(key, 0.0) + cost_delta
+
+    @staticmethod
+    def __write_rollups(rollups: dict):
+        # Різниця вартості додається до підсумків одним оновленням на лічильник і день або місяць
+        for collection, deltas in rollups.items():
+            if deltas:
+                collection.bulk_write([UpdateOne({"meter_id": meter_id, field: value}, {"$inc": {"cost": delta}})
+                                       for (meter_id, field, value), delta in deltas.items()], ordered=False)
+
+    def __usage(self, doc: dict) -> tuple[float, float]:
+        if "day_usage" in doc:
+            return doc["day_usage"], doc["night_usage"]
+
+        # Старі покази без збереженого споживання рахуємо від попереднього показу лічильника. Його
+        # переносимо з обходу, а шукаємо лише для першого показу лічильника на рівні чи після відновлення
+        previous = self.__previous
+        if not previous or previous["meter_id"] != doc["meter_id"]:
+            previous = self.__find_previous(doc)
+        if not previous:
+            return doc["day"], doc["night"]
+        return doc["day"] - previous["day"], doc["night"] - previous["night"]
+
+    def __find_previous(self, doc: dict) -> dict | None:
+        before = {"meter_id": doc["meter_id"], "$or": [{"date_time": {"$lt": doc["date_time"]}},
+                                                       {"date_time": doc["date_time"], "_id": {"$lt": doc["_id"]}}]}
+        sort = [("date_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+        previous = self.eb.meters_data.find_one(before, {"day": 1, "night": 1}, sort=sort)
+        if previous:
+            return previous
+        # Попередній показ міг бути перенесений в архів
+        archived = list(self.eb.meters_archive.aggregate(archive_pipeline(
+            before, sort, limit=1, buckets=bucket_filter(doc["meter_id"], date_to=doc["date_time"]))))
+        return archived[0] if archived else None
+
+    def __range_query(self) -> dict:
+        date_time = {}
+        if self.date_from:
+            date_time["$gte"] = self.date_from
+        if self.date_to:
+            date_time["$lt"] = self.date_to
+        return {"date_time": date_time} if date_time else {}
+
+    def __in_range(self, date_time: datetime) -> bool:
+        return (not self.date_from or date_time >= self.date_from) and (not self.date_to or date_time < self.date_to)
+
+    def __buckets_query(self, after: list | None) -> dict:
+        query = bucket_filter(date_from=self.date_from, date_to=self.date_to)
+        if after:
+            meter_id, month = after
+            query["$or"] = [{"meter_id": {"$gt": meter_id}}, {"meter_id": meter_id, "month": {"$gt": month}}]
+        return query
+
+    def __archived_count(self) -> int:
+        pipeline = [{"$match": bucket_filter(date_from=self.date_from, date_to=self.date_to)},
+                    {"$unwind": "$readings"}, {"$match": {f"readings.{field}": value
+                                                          for field, value in self.__range_query().items()}},
+                    {"$count": "readings"}]
+        counted = list(self.eb.meters_archive.aggregate(pipeline))
+        return counted[0]["readings"] if counted else 0
+
+    def __chunk_query(self, after: list | None) -> dict:
+        query = self.__range_query()
+        if after:
+            meter_id, date_time, _id = after
+            query = {"$and": [query, {"$or": [{"meter_id": {"$lt": meter_id}},
+                                              {"meter_id": meter_id, "date_time": {"$gt": date_time}},
+                                              {"meter_id": meter_id, "date_time": date_time, "_id": {"$gt": _id}}]}]}
+        return query
+
+    def __load_state(self) -> dict | None:
+        found = self.eb.general_data.find_one({"_id": _STATE_ID})
+        state = found and found.get("data")
+        # Продовжуємо лише незавершений запуск за той самий період і з тим самим порядком обходу.
+        # Перерахунок ідемпотентний, тож запуск зі старим форматом стану просто починається знову
+        if not state or state["finished"] or (state["date_from"], state["date_to"]) != (self.date_from, self.date_to) \
+                or state.get("order") != _ORDER:
+            return None
+        return state
+
+    def __save_state(self, state: dict):
+        self.eb.general_data.update_one({"_id": _STATE_ID}, {"$set": {"data": state}}, upsert=True)
@@ -0,0 +1,68 @@
+from collections.abc import Callable
+from datetime import datetime
+
+import pymongo
+from pymongo import UpdateOne
+
+from electricall_bills import ElectricalBills
+from readings_archive import compact_reading
+
+_CHUNK_SIZE = 5_000
+
+
+class RetentionJob:
+    """Переносить покази, старші за cutoff, з meters_data у помісячні бакети лічильників у meters_archive.
+
+    Частина показів спершу додається в бакети через $addToSet, а потім видаляється з meters_data, тож
+    після збою між цими кроками повторний запуск не продублює покази в архіві. Усі покази в архіві
+    старші за покази в meters_data — на цьому будується читання обох рівнів.
+    """
+
+    def __init__(self, eb: ElectricalBills, cutoff: datetime, chunk_size: int = _CHUNK_SIZE):
+        self.eb = eb
+        self.cutoff = cutoff
+        self.chunk_size = chunk_size
+
+    def run(self, progress: Callable[[dict, int], None] | None = None) -> dict:
+        state = {"moved": 0, "buckets": 0}
+        total = self.eb.meters_data.count_documents({"date_time": {"$lt": self.cutoff}})
+
+        while True:
+            # Перенесені покази видаляються, тож кожна наступна частина знову береться з початку
+            chunk = list(self.eb.meters_data.find({"date_time": {"$lt": self.cutoff}},
+                                                  sort=[("date_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                                                  limit=self.chunk_size))
+            if not chunk:
+                break
+
+            buckets: dict[tuple[int, str], list[dict]] = {}
+            for doc in chunk:
+                buckets.setdefault((doc["meter_id"], doc["date_time"].strftime("%Y-%m")), []).append(doc)
+
+            self.eb.meters_archive.bulk_write([UpdateOne(
+                {"meter_id": meter_id, "month": month},
+                {"$addToSet": {"readings": {"$each": [compact_reading(doc) for doc in docs]}},
+                 "$min": {"first": docs[0]["date_time"]}, "$max": {"last": docs[-1]["date_time"]}},
+                upsert=True
+            ) for (meter_id, month), docs in buckets.items()], ordered=True)
+            self.eb.meters_data.delete_many({"_id": {"$in": [doc["_id"] for doc in chunk]}})
+
+            state["moved"] += len(chunk)
+            state["buckets"] += len(buckets)
+            if progress:
+                progress(state, total)
+
+        return state
+
+
+def compact_readings(eb: ElectricalBills, chunk_size: int = _CHUNK_SIZE) -> int:
+    """Замінює вбудовані документи тарифу в старих показах на tariff_id."""
+    compacted = 0
+    while True:
+        chunk = list(eb.meters_data.find({"tariff": {"$exists": True}}, {"tariff._id": 1}, limit=chunk_size))
+        if not chunk:
+            return compacted
+        eb.meters_data.bulk_write([UpdateOne({"_id": doc["_id"]}, {"$set": {"tariff_id": doc["tariff"]["_id"]},
+                                                                   "$unset": {"tariff": ""}})
+                                   for doc in chunk], ordered=False)
+        compacted += len(chunk)
@@ -0,0 +1,44 @@
+from bisect import bisect_right
+from datetime import datetime
+
+import numpy as np
+import pymongo
+
+from electricall_bills import ElectricalBills
+
+
+class TariffTimeline:
+    """Відсортована в пам'яті історія активацій тарифів з пошуком чинного тарифу за часом."""
+
+    def __init__(self, tariffs: dict, activations: list[tuple[datetime, object]]):
+        self.tariffs = tariffs
+        # Активації тарифів, яких вже немає в tariff_history, пропускаємо
+        activations = sorted((date_time, tariff_id) for date_time, tariff_id in activations if tariff_id in tariffs)
+        self.__times = [date_time for date_time, _ in activations]
+        self.__tariff_ids = [tariff_id for _, tariff_id in activations]
+        self.__times_array = np.array(self.__times, dtype="datetime64[us]")
+
+    @classmethod
+    def load(cls, eb: ElectricalBills) -> "TariffTimeline":
+        tariffs = {tariff["_id"]: tariff for tariff in eb.tariff_history.find()}
+        activations = [(activation["date_time"], activation["tariff_id"]) for activation in
+                       eb.tariff_activations.find(sort=[("date_time", pymongo.ASCENDING)])]
+        return cls(tariffs, activations)
+
+    def at(self, date_time: datetime) -> dict | None:
+        """Тариф, чинний на момент date_time, або None, якщо тоді ще жоден не був активований."""
+        index = bisect_right(self.__times, date_time) - 1
+        return self.tariffs[self.__tariff_ids[index]] if index >= 0 else None
+
+    def resolve(self, date_times: list[datetime], fallback_ids: list) -> list[dict | None]:
+        """Тарифи для масиву моментів часу.
+
+        Покази, записані до першої збереженої активації (старі дані), отримують тариф зі своїм
+        fallback_id — тобто той самий, що вже вбудований у документ, але з актуальними цінами.
+        """
+        indexes = np.searchsorted(self.__times_array, np.array(date_times, dtype="datetime64[us]"), side="right") - 1
+        return [self.tariffs[self.__tariff_ids[index]] if index >= 0 else self.tariffs.get(fallback_id)
+                for index, fallback_id in zip(indexes.tolist(), fallback_ids)]
+
+    def __len__(self):
+        return len(self.__times)
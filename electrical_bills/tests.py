@@ -1,7 +1,31 @@
+import argparse
+import asyncio
+import io
+import json
 import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+from datetime import datetime, timedelta
 from mongomock import MongoClient
+import pika
+from pymongo.errors import BulkWriteError, PyMongoError
+from pydantic import ValidationError
 
 from electricall_bills import ElectricalBills
+from electrical_bills_updates_validator import AddMeterRequest, AddMeterDataRequest, LegacyActionRequest, \
+    parse_update, validate_and_execute_update
+from idempotency import IdempotencyStore
+from async_handler import AsyncHandler, ReadWriteLock
+import electrical_bills_handler as handler
+import anomaly
+import manage
+import metrics
+from rebilling import RebillingJob
+from retention import RetentionJob, compact_readings
+import readings_export
+import readings_import
+from tariff_timeline import TariffTimeline
 from electricall_bills_exceptions import *
 
 
@@ -10,6 +34,7 @@ class TestElectricalBills(unittest.TestCase):
         self.client = MongoClient()
         self.db = self.client["test_db"]
         self.eb = ElectricalBills(self.db)
+        self.eb.create_indexes()
 
     # Тести додавання показів
     def test_add_meter_data_meter_id_not_found(self):
@@ -32,9 +57,9 @@ class TestElectricalBills(unittest.TestCase):
         self.assertEqual(cost, 12.5)
         self.assertEqual(self.eb.meters_data.count_documents({}), 1)
 
-        last_data = self.db["general_data"].find_one({"_id": "last_meters_data"})["data"]
-        self.assertEqual(last_data["meter_id"], 1)
+        last_data = self.eb.meters_data.find_one({"meter_id": 1})
         self.assertEqual(last_data["day"], 10.0)
+        self.assertIsNone(self.db["general_data"].find_one({"_id": "last_meters_data"}))
 
     def test_add_meter_data_subsequent_greater_values(self):
         """Додавання нових показів більших за попередні"""
@@ -84,8 +109,703 @@ class TestElectricalBills(unittest.TestCase):
 
         self.eb.add_meter_data(1, 10.0, 5.0)
         cost, _ = self.eb.add_meter_data(2, 20.0, 10.0)
+        self.assertEqual(cost, 25.0)
+
+        cost, fake = self.eb.add_meter_data(1, 12.0, 6.0)
+        self.assertEqual(cost, 2.5)
+        self.assertFalse(fake)
+
+    # Тести профілю споживання
+    def test_add_meter_data_spike_uses_meter_profile(self):
+        """Стрибок споживання замінюється типовим споживанням лічильника"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for i in range(anomaly.MIN_SAMPLES + 1):
+            self.eb.add_meter_data(1, 10.0 * (i + 1), 5.0 * (i + 1))
+
+        cost, fake = self.eb.add_meter_data(1, 500.0, 35.0)
+        self.assertTrue(fake)
+        self.assertEqual(cost, 1.0 * 10 + 0.5 * 5)
+        self.assertIsNotNone(self.eb.meters_data.find_one({"meter_id": 1, "day": 500.0, "night": 35.0,
+                                                           "day_usage": 10.0}))
+
+        # Профіль переживає перезапуск, а відкат теж коригується за ним
+        eb = ElectricalBills(self.db)
+        cost, fake = eb.add_meter_data(1, 60.0, 40.0)
+        self.assertTrue(fake)
+        self.assertEqual(cost, 1.0 * 10 + 0.5 * 5)
+        self.assertEqual(self.db["meter_profiles"].find_one({"meter_id": 1})["day"]["count"], anomaly.MIN_SAMPLES)
+
+    def test_add_meter_data_step_change_rebaselines_profile(self):
+        """Кілька стрибків поспіль перебудовують профіль, а покази зберігаються фактичні"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        day = 0.0
+        for i in range(anomaly.MIN_SAMPLES + 1):
+            day += 10.0
+            self.eb.add_meter_data(1, day, 5.0)
+
+        for i in range(anomaly.REBASELINE_SPIKES):
+            day += 25.0
+            cost, fake = self.eb.add_meter_data(1, day, 5.0)
+            self.assertEqual(fake, i < anomaly.REBASELINE_SPIKES - 1)
+        self.assertEqual(cost, 25.0)
+
+        cost, fake = self.eb.add_meter_data(1, day + 25.0, 5.0)
+        self.assertFalse(fake)
+        self.assertEqual(cost, 25.0)
+        last = self.eb.meters_data.find_one({"meter_id": 1}, sort=[("date_time", -1), ("_id", -1)])
+        self.assertEqual(last["day"], day + 25.0)
+
+    def test_add_meter_data_zero_usage_profile_not_trusted(self):
+        """Профіль з нульовим споживанням не робить стрибком перше справжнє споживання"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for i in range(anomaly.MIN_SAMPLES + 1):
+            self.eb.add_meter_data(1, 10.0, 5.0)
+
+        cost, fake = self.eb.add_meter_data(1, 40.0, 5.0)
+        self.assertFalse(fake)
+        self.assertEqual(cost, 30.0)
+        cost, fake = self.eb.add_meter_data(1, 70.0, 5.0)
+        self.assertEqual((cost, fake), (30.0, False))
+
+    def test_spike_threshold_floor(self):
+        """Для майже нульового середнього поріг стрибка не менший за SPIKE_MIN_USAGE"""
+        stats = anomaly.RunningStats()
+        for i in range(anomaly.MIN_SAMPLES):
+            stats.update(0.1)
+
+        self.assertEqual(anomaly.check_usage(stats, 3.0, 100.0), (3.0, None))
+        self.assertEqual(anomaly.check_usage(stats, 50.0, 100.0), (stats.mean, anomaly.SPIKE))
+        # Профіль, збережений до появи лічильника ненульових значень
+        self.assertEqual(anomaly.RunningStats(6, 0.0, 0.0).spike_threshold(), None)
+
+    def test_scan_anomalies(self):
+        """Векторна перевірка історії знаходить відкати й стрибки та будує профілі"""
+        self.db["meters_data"].insert_many(
+            [{"meter_id": 1, "day": 10.0 * i, "night": 5.0 * i, "date_time": datetime(2024, 1, i + 1)}
+             for i in range(1, 8)] +
+            [{"meter_id": 1, "day": 500.0, "night": 40.0, "date_time": datetime(2024, 1, 9)},
+             {"meter_id": 2, "day": 10.0, "night": 5.0, "date_time": datetime(2024, 1, 1)},
+             {"meter_id": 2, "day": 8.0, "night": 6.0, "date_time": datetime(2024, 1, 2)}])
+
+        found, profiles, scanned = anomaly.scan_history(self.db["meters_data"])
+        self.assertEqual(scanned, 10)
+        self.assertEqual([(reading["meter_id"], reading["kind"]) for reading in found],
+                         [(2, anomaly.ROLLBACK), (1, anomaly.SPIKE)])
+
+        self.eb.save_profiles(profiles)
+        profile = self.db["meter_profiles"].find_one({"meter_id": 1})
+        self.assertEqual((profile["day"]["count"], profile["day"]["mean"]), (6, 10.0))
+
+    # Тести прогріву
+    def test_missing_indexes(self):
+        """Воркер не стартує, доки міграція не створила унікальні індекси та TTL-індекс ключів ідемпотентності"""
+        eb = ElectricalBills(self.client["fresh_db"])
+        idempotency = IdempotencyStore(self.client["fresh_db"])
+        self.assertIn("meters(meter_id)", eb.missing_indexes())
+        with self.assertRaises(SystemExit):
+            handler.require_indexes(eb, idempotency)
+
+        eb.create_indexes()
+        self.assertEqual(eb.missing_indexes(), [])
+        self.assertEqual(self.eb.missing_indexes(), [])
+        with self.assertRaises(SystemExit):
+            handler.require_indexes(eb, idempotency)
+
+        idempotency.create_indexes()
+        handler.require_indexes(eb, idempotency)
+        # Індекс з іншим TTL не рахується
+        self.assertEqual(len(IdempotencyStore(self.client["fresh_db"], ttl=60).missing_indexes()), 1)
+
+    def test_warm_up(self):
+        """Прогрів завантажує поточний тариф і відомі лічильники"""
+        self.eb.add_meter(1)
+        self.eb.add_meter(2)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+
+        eb = ElectricalBills(self.db, cache_size=1)
+        self.assertEqual(eb.warm_up(), {"meters": 1, "current_tariff": True})
+        self.assertEqual(eb.add_meter_data(1, 10.0, 5.0), (12.5, False))
+
+    def test_readiness_probe(self):
+        """/readyz відповідає 503, поки воркер не готовий, а /healthz — завжди 200"""
+        server = metrics.start_http_server(0, "127.0.0.1")
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            metrics.READY.clear()
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(f"{url}/readyz")
+            self.assertEqual(context.exception.code, 503)
+            self.assertEqual(urllib.request.urlopen(f"{url}/healthz").status, 200)
+
+            metrics.READY.set()
+            self.assertEqual(urllib.request.urlopen(f"{url}/readyz").status, 200)
+        finally:
+            metrics.READY.clear()
+            server.shutdown()
+            server.server_close()
+
+    # Тести кешу
+    def test_add_meter_data_cache_cold_start(self):
+        """Останні покази відновлюються з бази після перезапуску"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+
+        eb = ElectricalBills(self.db)
+        cost, fake = eb.add_meter_data(1, 15.0, 7.0)
+        self.assertEqual(cost, 6.0)
+        self.assertFalse(fake)
+
+    def test_add_meter_data_cache_eviction(self):
+        """Витіснення холодних лічильників з кешу"""
+        eb = ElectricalBills(self.db, cache_size=1)
+        eb.add_meter(1)
+        eb.add_meter(2)
+        eb.add_tariff(1.0, 0.5, set_as_current=True)
+        eb.add_meter_data(1, 10.0, 5.0)
+        eb.add_meter_data(2, 20.0, 10.0)
+
+        cost, _ = eb.add_meter_data(1, 11.0, 5.0)
+        self.assertEqual(cost, 1.0)
+
+    def test_add_meter_data_cache_tariff_switch(self):
+        """Зміна тарифу одразу застосовується до нових показів"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        self.eb.add_tariff(2.0, 1.0, set_as_current=True)
+
+        cost, _ = self.eb.add_meter_data(1, 11.0, 6.0)
+        self.assertEqual(cost, 3.0)
+
+    def test_add_meter_data_meter_added_elsewhere(self):
+        """Лічильник, доданий іншим процесом, знаходиться без скидання кешу"""
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        with self.assertRaises(MeterIdNotFoundError):
+            self.eb.add_meter_data(1, 10.0, 5.0)
+
+        ElectricalBills(self.db).add_meter(1)
+        cost, _ = self.eb.add_meter_data(1, 10.0, 5.0)
         self.assertEqual(cost, 12.5)
 
+    # Тести пакетного режиму
+    def test_bulk_writes_on_exit(self):
+        """Покази в пакеті записуються лише після виходу з bulk()"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+
+        with self.eb.bulk():
+            self.eb.add_meter_data(1, 10.0, 5.0)
+            cost, _ = self.eb.add_meter_data(1, 15.0, 7.0)
+            self.assertEqual(self.eb.meters_data.count_documents({}), 0)
+
+        self.assertEqual(cost, 6.0)
+        days = [doc["day"] for doc in self.eb.meters_data.find(sort=[("date_time", 1)])]
+        self.assertEqual(days, [10.0, 15.0])
+
+    def test_bulk_rollups_one_write_per_collection(self):
+        """Підсумки пакета записуються одним bulk_write на колекцію"""
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for meter_id in range(3):
+            self.eb.add_meter(meter_id)
+
+        with mock.patch.object(self.eb.meters_daily, "update_one") as update_one, \
+                mock.patch.object(self.eb.meters_daily, "bulk_write", wraps=self.eb.meters_daily.bulk_write) as daily:
+            with self.eb.bulk():
+                for meter_id in range(3):
+                    self.eb.add_meter_data(meter_id, 10.0, 5.0)
+                    self.eb.add_meter_data(meter_id, 15.0, 7.0)
+
+        update_one.assert_not_called()
+        self.assertEqual(daily.call_count, 1)
+        self.assertEqual([doc["readings"] for doc in self.eb.meters_daily.find()], [2, 2, 2])
+        self.assertEqual([doc["cost"] for doc in self.eb.meters_monthly.find()], [18.5, 18.5, 18.5])
+
+    def test_bulk_profiles_one_write(self):
+        """Профілі лічильників пакета записуються одним bulk_write"""
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for meter_id in range(3):
+            self.eb.add_meter(meter_id)
+            self.eb.add_meter_data(meter_id, 10.0, 5.0)
+
+        profiles = self.eb.meter_profiles
+        with mock.patch.object(profiles, "update_one") as update_one, \
+                mock.patch.object(profiles, "bulk_write", wraps=profiles.bulk_write) as bulk_write:
+            with self.eb.bulk():
+                for meter_id in range(3):
+                    self.eb.add_meter_data(meter_id, 15.0, 7.0)
+
+        update_one.assert_not_called()
+        self.assertEqual(bulk_write.call_count, 1)
+        self.assertEqual([doc["day"]["count"] for doc in profiles.find()], [1, 1, 1])
+
+    def test_bulk_tariff_switch(self):
+        """Зміна тарифу в пакеті застосовується до наступних показів"""
+        self.eb.add_meter(1)
+        first_id = self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        second_id = self.eb.add_tariff(2.0, 1.0)
+
+        with self.eb.bulk():
+            self.eb.add_meter_data(1, 10.0, 5.0)
+            self.eb.set_tariff(str(second_id))
+            cost, _ = self.eb.add_meter_data(1, 11.0, 6.0)
+
+        self.assertEqual(cost, 3.0)
+        current_tariff = self.db["general_data"].find_one({"_id": "current_tariff"})["data"]
+        self.assertEqual(current_tariff["_id"], second_id)
+        self.assertNotEqual(current_tariff["_id"], first_id)
+
+    def test_readings_batch_request(self):
+        """Пакет показів повертає результат для кожного рядка"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+
+        results = validate_and_execute_update(self.eb, {"data": {"readings": [
+            {"meter_id": 1, "day": 10.0, "night": 5.0},
+            {"meter_id": 2, "day": 10.0, "night": 5.0},
+            {"meter_id": 1, "day": 15.0, "night": 7.0},
+        ]}})
+
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], MeterIdNotFoundError)
+        self.assertIsNone(results[2])
+        self.assertEqual(self.eb.meters_data.count_documents({}), 2)
+
+    def test_bulk_partial_flush(self):
+        """Збій після частини записів пакета повідомляється окремою помилкою"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+
+        with mock.patch.object(self.eb.meters_daily, "bulk_write", side_effect=PyMongoError("down")):
+            with self.assertRaises(PartialBulkWriteError):
+                with self.eb.bulk():
+                    self.eb.add_meter_data(1, 10.0, 5.0)
+        with mock.patch.object(self.eb.meters_data, "bulk_write", side_effect=PyMongoError("down")):
+            with self.assertRaises(PyMongoError) as raised:
+                with self.eb.bulk():
+                    self.eb.add_meter_data(1, 15.0, 7.0)
+        self.assertNotIsInstance(raised.exception, PartialBulkWriteError)
+        self.assertEqual(self.eb.meters_data.count_documents({}), 1)
+
+    def test_batch_consumer_does_not_requeue_direct_writes(self):
+        """Запит, що пише одразу, підтверджується до наступних показів і не повертається в чергу при збої"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        handler.channel = channel = mock.Mock()
+        self.addCleanup(setattr, handler, "channel", None)
+        consumer = handler.BatchConsumer(self.eb, IdempotencyStore(self.db), 10, 1.0)
+        bodies = [{"data": {"type": "add_meter_data", "meter_id": 1, "day": 10.0, "night": 5.0}},
+                  {"data": {"type": "add_tariff", "day_tariff": 2.0, "night_tariff": 1.0}},
+                  {"data": {"type": "add_meter_data", "meter_id": 1, "day": 15.0, "night": 7.0}}]
+        consumer.batch = [(mock.Mock(delivery_tag=tag), pika.BasicProperties(reply_to="replies", correlation_id=str(tag)),
+                           json.dumps(body).encode()) for tag, body in enumerate(bodies, start=1)]
+
+        bulk_write = self.eb.meters_data.bulk_write
+
+        def flaky_bulk_write(*args, **kwargs):
+            # Перший пакет показів записується, другий — ні
+            if flaky.call_count > 1:
+                raise PyMongoError("down")
+            return bulk_write(*args, **kwargs)
+
+        with mock.patch.object(self.eb.meters_data, "bulk_write", side_effect=flaky_bulk_write) as flaky:
+            consumer.flush()
+
+        self.assertEqual([call.kwargs["delivery_tag"] for call in channel.basic_ack.call_args_list], [1, 2])
+        channel.basic_nack.assert_called_once_with(delivery_tag=3, multiple=True, requeue=True)
+        self.assertEqual(self.eb.tariff_history.count_documents({}), 2)
+        self.assertEqual(self.eb.meters_data.count_documents({}), 1)
+
+    # Тести підсумків споживання
+    def test_rollups_incremented(self):
+        """Денні та місячні підсумки оновлюються разом з показами"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        self.eb.add_meter_data(1, 15.0, 7.0)
+
+        date_time = self.eb.meters_data.find_one()["date_time"]
+        daily = self.eb.get_daily_usage(1, date_time.strftime("%Y-%m-%d"))
+        monthly = self.eb.get_monthly_usage(1, date_time.strftime("%Y-%m"))
+        for rollup in (daily, monthly):
+            self.assertEqual(rollup["day_usage"], 15.0)
+            self.assertEqual(rollup["night_usage"], 7.0)
+            self.assertEqual(rollup["cost"], 18.5)
+            self.assertEqual(rollup["readings"], 2)
+
+    def test_rebuild_rollups(self):
+        """Перерахунок підсумків з сирих показів"""
+        self.eb.add_meter(1)
+        self.eb.add_meter(2)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        with self.eb.bulk():
+            self.eb.add_meter_data(1, 10.0, 5.0)
+            self.eb.add_meter_data(2, 20.0, 10.0)
+            self.eb.add_meter_data(1, 9.0, 6.0)
+        before = list(self.eb.meters_monthly.find({}, {"_id": 0}).sort("meter_id", 1))
+
+        self.eb.meters_monthly.delete_many({})
+        self.eb.rebuild_rollups()
+
+        after = list(self.eb.meters_monthly.find({}, {"_id": 0}).sort("meter_id", 1))
+        self.assertEqual(after, before)
+        self.assertEqual(after[0]["day_usage"], 110.0)
+
+    # Тести історії тарифів і перерахунку вартості
+    def test_tariff_timeline_lookup(self):
+        """Пошук тарифу, чинного на момент показу"""
+        first = self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        second = self.eb.add_tariff(2.0, 1.0)
+        self.assertEqual(len(TariffTimeline.load(self.eb)), 1)
+
+        tariffs = {tariff["_id"]: tariff for tariff in self.eb.tariff_history.find()}
+        timeline = TariffTimeline(tariffs, [(datetime(2024, 3, 1), second), (datetime(2024, 1, 1), first)])
+        self.assertIsNone(timeline.at(datetime(2023, 12, 31)))
+        self.assertEqual(timeline.at(datetime(2024, 1, 1))["_id"], first)
+        self.assertEqual(timeline.at(datetime(2024, 5, 1))["_id"], second)
+        self.assertEqual([tariff and tariff["_id"] for tariff in timeline.resolve(
+            [datetime(2023, 1, 1), datetime(2024, 2, 1), datetime(2024, 3, 1)], [second, None, None])],
+            [second, first, second])
+
+    def test_rebill_corrected_tariff(self):
+        """Після виправлення цін тарифу вартість показів і підсумки перераховуються"""
+        self.eb.add_meter(1)
+        tariff_id = self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        self.eb.add_meter_data(1, 15.0, 7.0)
+        self.assertTrue(self.eb.correct_tariff(str(tariff_id), 2.0, 1.0))
+
+        state = RebillingJob(self.eb, chunk_size=1).run()
+        self.assertEqual((state["scanned"], state["updated"], state["cost_delta"]), (2, 2, 18.5))
+        self.assertEqual(sorted(doc["cost"] for doc in self.eb.meters_data.find()), [12.0, 25.0])
+        self.assertEqual(self.eb.meters_monthly.find_one()["cost"], 37.0)
+        self.assertEqual(self.eb.get_current_tariff()["day_tariff"], 2.0)
+        self.assertEqual(self.eb.add_meter_data(1, 16.0, 8.0), (3.0, False))
+
+    def test_correct_tariff_notifies_by_default(self):
+        """correct-tariff повідомляє обробники про зміну тарифу, якщо не вказано --no-notify"""
+        tariff_id = self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for notify, calls in ((True, 2), (False, 0)):
+            args = argparse.Namespace(
+                tariff_id=str(tariff_id), day_tariff=2.0, night_tariff=1.0, notify=notify, chunk_size=10,
+                restart=False)
+            with mock.patch.object(manage, "notify_tariff_changed") as notify_tariff_changed, \
+                    mock.patch("builtins.print"):
+                manage.correct_tariff(self.eb, args)
+            self.assertEqual(notify_tariff_changed.call_count, calls)
+
+    def test_rebill_resumes(self):
+        """Перерваний перерахунок продовжується з останньої записаної позиції"""
+        self.eb.add_meter(1)
+        tariff_id = self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for day in (10.0, 15.0, 20.0):
+            self.eb.add_meter_data(1, day, day)
+        self.eb.correct_tariff(str(tariff_id), 2.0, 1.0)
+
+        def stop(state, total):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            RebillingJob(self.eb, chunk_size=1).run(progress=stop)
+        state = RebillingJob(self.eb, chunk_size=1).run()
+        self.assertEqual((state["scanned"], state["updated"]), (3, 3))
+        self.assertEqual(RebillingJob(self.eb).run()["updated"], 0)
+
+    # Тести архіву показів
+    def test_archive_readings(self):
+        """Старі покази переносяться в помісячні бакети, а наступний показ рахується від архівного"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        self.eb.add_meter_data(1, 15.0, 7.0)
+
+        cutoff = datetime.now() + timedelta(seconds=1)
+        self.assertEqual(RetentionJob(self.eb, cutoff, chunk_size=1).run()["moved"], 2)
+        RetentionJob(self.eb, cutoff).run()
+        self.assertEqual(self.eb.meters_data.count_documents({}), 0)
+        bucket = self.eb.meters_archive.find_one({"meter_id": 1})
+        self.assertEqual([reading["day"] for reading in bucket["readings"]], [10.0, 15.0])
+        self.assertNotIn("meter_id", bucket["readings"][0])
+
+        eb = ElectricalBills(self.db)
+        self.assertEqual(eb.add_meter_data(1, 16.0, 8.0), (1.5, False))
+        eb.rebuild_rollups()
+        self.assertEqual(eb.meters_monthly.find_one({"meter_id": 1})["readings"], 3)
+
+    def test_rebill_archived_readings(self):
+        """Перерахунок вартості оновлює й архівні покази"""
+        self.eb.add_meter(1)
+        tariff_id = self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        self.eb.add_meter_data(1, 15.0, 7.0)
+        RetentionJob(self.eb, datetime.now() + timedelta(seconds=1)).run()
+        self.eb.correct_tariff(str(tariff_id), 2.0, 1.0)
+
+        state = RebillingJob(self.eb).run()
+        self.assertEqual((state["scanned"], state["updated"], state["cost_delta"]), (2, 2, 18.5))
+        bucket = self.eb.meters_archive.find_one({"meter_id": 1})
+        self.assertEqual([reading["cost"] for reading in bucket["readings"]], [25.0, 12.0])
+        self.assertEqual(self.eb.meters_monthly.find_one()["cost"], 37.0)
+
+    def test_rebill_resumes_state_without_archive_after(self):
+        """Стан перерахунку в старому форматі не зриває запуск, а перерахунок починається знову"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        self.eb.general_data.insert_one({"_id": "rebilling", "data": {
+            "date_from": None, "date_to": None, "after": None, "scanned": 0, "updated": 0, "cost_delta": 0.0,
+            "finished": False}})
+
+        state = RebillingJob(self.eb).run()
+        self.assertEqual((state["scanned"], state["finished"]), (1, True))
+
+    def test_rebill_legacy_readings_after_archive(self):
+        """Споживання старих показів рахується від попереднього показу, навіть якщо той уже в архіві"""
+        tariff_id = self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for meter_id in (1, 2):
+            self.eb.meters_data.insert_many([
+                {"meter_id": meter_id, "day": 10.0 * meter_id, "night": 5.0, "cost": 0.0,
+                 "date_time": datetime(2024, 1, 1), "tariff_id": tariff_id},
+                {"meter_id": meter_id, "day": 15.0 * meter_id, "night": 7.0, "cost": 0.0,
+                 "date_time": datetime(2024, 3, 1), "tariff_id": tariff_id},
+                {"meter_id": meter_id, "day": 20.0 * meter_id, "night": 8.0, "cost": 0.0,
+                 "date_time": datetime(2024, 3, 2), "tariff_id": tariff_id}])
+        RetentionJob(self.eb, datetime(2024, 2, 1)).run()
+
+        # Частини по одному показу: попередній показ переноситься між частинами та з архіву
+        RebillingJob(self.eb, chunk_size=1).run()
+        costs = {(doc["meter_id"], doc["date_time"]): doc["cost"] for doc in self.eb.meters_data.find()}
+        self.assertEqual(costs, {(1, datetime(2024, 3, 1)): 6.0, (1, datetime(2024, 3, 2)): 5.5,
+                                 (2, datetime(2024, 3, 1)): 11.0, (2, datetime(2024, 3, 2)): 10.5})
+        bucket = self.eb.meters_archive.find_one({"meter_id": 2})
+        self.assertEqual(bucket["readings"][0]["cost"], 22.5)
+
+    def test_compact_readings(self):
+        """Вбудований тариф старих показів замінюється посиланням"""
+        tariff_id = self.eb.add_tariff(1.0, 0.5)
+        tariff = self.eb.tariff_history.find_one({"_id": tariff_id})
+        self.eb.meters_data.insert_one({"meter_id": 1, "day": 1.0, "night": 1.0, "cost": 1.5,
+                                        "date_time": datetime(2024, 1, 1), "tariff": tariff})
+
+        self.assertEqual(compact_readings(self.eb), 1)
+        doc = self.eb.meters_data.find_one()
+        self.assertEqual(doc["tariff_id"], tariff_id)
+        self.assertNotIn("tariff", doc)
+
+    # Тести експорту показів
+    def test_export_csv(self):
+        """Експорт у CSV з фільтром за лічильником і періодом"""
+        self.eb.add_meter(1)
+        self.eb.add_meter(2)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        self.eb.add_meter_data(2, 20.0, 10.0)
+        self.eb.add_meter_data(1, 15.0, 7.0)
+
+        docs = self.eb.meters_data.find(readings_export.export_query(1, datetime(2000, 1, 1)),
+                                        readings_export.PROJECTION, sort=readings_export.SORT)
+        lines = readings_export.csv_chunk(docs, header=True).splitlines()
+        self.assertEqual(lines[0], ",".join(readings_export.COLUMNS))
+        self.assertEqual([line.split(",")[-1] for line in lines[1:]], ["12.5", "6.0"])
+        self.assertEqual(readings_export.export_query(date_to=datetime(2000, 1, 1)),
+                         {"date_time": {"$lt": datetime(2000, 1, 1)}})
+
+    def test_export_archive_streams_buckets(self):
+        """Архів експортується бакетами за лічильником і часом, без розгортання всього архіву"""
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for meter_id in (2, 1):
+            self.eb.add_meter(meter_id)
+            self.eb.add_meter_data(meter_id, 10.0, 5.0)
+            self.eb.add_meter_data(meter_id, 15.0, 7.0)
+        RetentionJob(self.eb, datetime.now() + timedelta(seconds=1)).run()
+
+        buckets = self.eb.meters_archive.find(readings_export.bucket_filter(), readings_export.ARCHIVE_PROJECTION,
+                                              sort=readings_export.ARCHIVE_SORT)
+        docs = list(readings_export.iter_archive(buckets))
+        self.assertEqual([(doc["meter_id"], doc["day"]) for doc in docs], [(1, 10.0), (1, 15.0), (2, 10.0), (2, 15.0)])
+        self.assertNotIn("_id", docs[0])
+        self.assertEqual(readings_export.csv_chunk(docs[:1], tariffs={docs[0]["tariff_id"]: {"day_tariff": 1.0}})
+                         .split(",")[-3:], ["1.0", "", "12.5\n"])
+        bucket = self.eb.meters_archive.find_one({"meter_id": 1})
+        self.assertEqual(readings_export.bucket_rows(bucket, date_to=datetime.now() + timedelta(days=1)), docs[:2])
+        self.assertEqual(readings_export.bucket_rows(bucket, date_from=datetime.now() + timedelta(days=1)), [])
+
+    # Тести імпорту показів
+    def test_import_direct(self):
+        """Імпорт CSV з полем у лапках на кількох рядках; скоригований показ вважається прийнятим"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        lines = io.StringIO('meter_id,day,night,comment\n1,10,5,"перший\nпоказ"\n1,9,6,\n1,x,7,\n', newline="")
+
+        summary = readings_import.import_direct(self.eb, lines, "csv")
+        self.assertEqual((summary["total"], summary["accepted"], summary["corrected"], summary["failed"]),
+                         (3, 2, 1, 1))
+        self.assertEqual(summary["errors"][0]["row"], 5)
+        self.assertEqual(self.eb.meters_data.count_documents({}), 2)
+
+        parser = readings_import.ReadingsParser("csv")
+        results = [parser.parse_line(line) for line in ("meter_id,day,night,comment", '1,10,5,"перший', 'показ"')]
+        self.assertEqual(results[:2], [None, None])
+        self.assertEqual(results[2].day, 10.0)
+
+    def test_import_direct_notifies_handlers(self):
+        """Після імпорту --direct обробник скидає закешований останній показ імпортованих лічильників"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        written = []
+
+        lines = io.StringIO("meter_id,day,night\n1,20,6\n2,1,1\n", newline="")
+        readings_import.import_direct(ElectricalBills(self.db), lines, "csv", on_written=written.extend)
+        self.assertEqual(written, [1])
+
+        self.eb.invalidate_meters(written)
+        self.assertEqual(self.eb.add_meter_data(1, 25.0, 7.0), (5.5, False))
+
+    # Тести валідації повідомлень
+    def test_parse_update_tagged_bytes(self):
+        """Повідомлення з type валідується з сирих байтів"""
+        request = parse_update(b'{"data": {"type": "add_meter", "meter_id": 3}}')
+        self.assertIsInstance(request.data, AddMeterRequest)
+        with self.assertRaises(ValidationError):
+            parse_update(b'{"data": {"type": "add_meter_data", "meter_id": 3}}')
+        with self.assertRaises(ValidationError):
+            parse_update(b'not json')
+
+    def test_parse_update_legacy(self):
+        """Повідомлення без type розбирається старим способом"""
+        request = parse_update({"data": {"meter_id": 3, "day": 1, "night": 2}, "routing_key": "reply"})
+        self.assertIsInstance(request, LegacyActionRequest)
+        self.assertIsInstance(request.data, AddMeterDataRequest)
+        self.assertEqual(request.routing_key, "reply")
+
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.assertIsNone(validate_and_execute_update(self.eb, b'{"data": {"meter_id": 1, "day": 1, "night": 1}}'))
+        self.assertEqual(self.eb.meters_data.count_documents({}), 1)
+
+    # Тести асинхронного обробника
+    def test_async_handler_concurrent_readings(self):
+        """Одночасна обробка показів різних лічильників дає той самий результат, що й послідовна"""
+        for meter_id in range(4):
+            self.eb.add_meter(meter_id)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        handler = AsyncHandler(self.eb, IdempotencyStore(self.db), None, None, concurrency=4)
+
+        async def run():
+            requests = [parse_update({"data": {"type": "add_meter_data", "meter_id": i % 4,
+                                               "day": float(i), "night": float(i)}}) for i in range(40)]
+            return await asyncio.gather(*(handler.execute(request) for request in requests))
+
+        self.assertEqual(asyncio.run(run()), [None] * 40)
+        handler.executor.shutdown()
+        for meter_id in range(4):
+            days = [doc["day"] for doc in self.eb.meters_data.find({"meter_id": meter_id}).sort("date_time", 1)]
+            self.assertEqual(days, [float(i) for i in range(meter_id, 40, 4)])
+            self.assertEqual(self.eb.meters_monthly.find_one({"meter_id": meter_id})["cost"],
+                             1.5 * (36 + meter_id))
+
+    def test_read_write_lock(self):
+        """Зміна тарифу чекає на покази в обробці та не пропускає вперед нові"""
+        lock = ReadWriteLock()
+        order = []
+
+        async def reader(name: str, delay: float):
+            async with lock.shared():
+                order.append(f"{name}+")
+                await asyncio.sleep(delay)
+                order.append(f"{name}-")
+
+        async def writer():
+            async with lock.exclusive():
+                order.append("tariff")
+
+        async def run():
+            first = asyncio.create_task(reader("r1", 0.02))
+            await asyncio.sleep(0)
+            switch = asyncio.create_task(writer())
+            await asyncio.sleep(0)
+            await asyncio.gather(first, switch, reader("r2", 0))
+
+        asyncio.run(run())
+        self.assertEqual(order, ["r1+", "r1-", "tariff", "r2+", "r2-"])
+
+    # Тести ідемпотентності
+    def test_idempotent_reading_applied_once(self):
+        """Повтор показу з тим самим ключем не записується вдруге"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        store = IdempotencyStore(self.db)
+        message = {"data": {"meter_id": 1, "day": 10.0, "night": 5.0, "idempotency_key": "reading-1"}}
+
+        self.assertIsNone(validate_and_execute_update(self.eb, message, store))
+        self.assertIsNone(validate_and_execute_update(self.eb, message, IdempotencyStore(self.db)))
+        self.assertEqual(self.eb.meters_data.count_documents({}), 1)
+
+    def test_idempotent_duplicate_in_batch(self):
+        """Дублікат у пакеті не рахується як накручений показ"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        store = IdempotencyStore(self.db)
+        reading = {"meter_id": 1, "day": 10.0, "night": 5.0, "idempotency_key": "reading-1"}
+
+        results = validate_and_execute_update(self.eb, {"data": {"readings": [reading, reading]}}, store)
+        self.assertEqual(results, [None, None])
+        self.assertEqual(self.eb.meters_data.count_documents({}), 1)
+        self.assertEqual(store.processed_requests.count_documents({}), 1)
+
+    def test_idempotent_keys_kept_for_applied_part_of_batch(self):
+        """Після частково записаного пакета повтор не записує вдруге вже застосовані покази"""
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        for meter_id in range(3):
+            self.eb.add_meter(meter_id)
+        store = IdempotencyStore(self.db)
+        message = {"data": {"readings": [{"meter_id": meter_id, "day": 10.0, "night": 5.0,
+                                          "idempotency_key": f"reading-{meter_id}"} for meter_id in range(3)]}}
+        bulk_write = self.eb.meters_data.bulk_write
+
+        def partial_bulk_write(requests, **kwargs):
+            bulk_write(requests[:1], **kwargs)
+            raise BulkWriteError({"nInserted": 1, "writeErrors": []})
+
+        with mock.patch.object(self.eb.meters_data, "bulk_write", side_effect=partial_bulk_write):
+            self.assertIsInstance(validate_and_execute_update(self.eb, message, store), PartialBulkWriteError)
+        self.assertEqual([doc["_id"] for doc in store.processed_requests.find()], ["reading-0"])
+
+        self.assertEqual(validate_and_execute_update(self.eb, message, IdempotencyStore(self.db)), [None] * 3)
+        self.assertEqual(sorted(doc["meter_id"] for doc in self.eb.meters_data.find()), [0, 1, 2])
+
+    def test_idempotent_result_replayed(self):
+        """Повтор повертає збережений результат без повторного виконання"""
+        store = IdempotencyStore(self.db)
+        message = {"data": {"meter_id": 1, "idempotency_key": "meter-1"}}
+
+        self.assertIsNone(validate_and_execute_update(self.eb, message, store))
+        self.eb.meters.delete_many({})
+        self.assertIsNone(validate_and_execute_update(self.eb, message, store))
+        self.assertEqual(self.eb.meters.count_documents({}), 0)
+
+    def test_idempotent_error_type_replayed(self):
+        """Повтор відновлює тип помилки, а тимчасові збої не зберігаються"""
+        self.eb.add_meter(1)
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter_data(1, 10.0, 5.0)
+        store = IdempotencyStore(self.db)
+        message = {"data": {"meter_id": 1, "day": 9.0, "night": 6.0, "idempotency_key": "reading-1"}}
+
+        self.assertIsInstance(validate_and_execute_update(self.eb, message, store), FakeMeterDataError)
+        self.assertIsInstance(validate_and_execute_update(self.eb, message, IdempotencyStore(self.db)),
+                              FakeMeterDataError)
+
+        message = {"data": {"meter_id": 2, "idempotency_key": "meter-2"}}
+        with mock.patch.object(self.eb.meters, "insert_one", side_effect=PyMongoError("down")):
+            self.assertIsInstance(validate_and_execute_update(self.eb, message, store), PyMongoError)
+        self.assertIsNone(validate_and_execute_update(self.eb, message, store))
+        self.assertEqual(self.eb.meters.count_documents({"meter_id": 2}), 1)
+
     # Тести додавання лічильників
     def test_add_meter_negative_id(self):
         """Спроба додати лічильник з від'ємним ID"""
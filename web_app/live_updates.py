@@ -0,0 +1,39 @@
+import asyncio
+import json
+from collections.abc import AsyncIterator
+
+
+class LiveUpdates:
+    """Розсилка подій підключеним через Server-Sent Events браузерам.
+
+    Кожен клієнт має обмежену чергу; клієнта, що не встигає її вичитувати, відключаємо.
+    """
+
+    def __init__(self, queue_size: int = 100, heartbeat: float = 15):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.__clients: set[asyncio.Queue] = set()
+
+    def __bool__(self):
+        return bool(self.__clients)
+
+    def broadcast(self, event: str, data: dict):
+        message = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        for queue in list(self.__clients):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.__clients.discard(queue)
+
+    async def stream(self) -> AsyncIterator[str]:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.__clients.add(queue)
+        try:
+            yield ": connected\n\n"
+            while queue in self.__clients:
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            self.__clients.discard(queue)
@@ -0,0 +1,416 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "electrical_bills"))
+from benchmarks import SEED, git_commit, percentile  # noqa: E402
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+DEFAULT_MIX = "add_reading=70,index=15,meters=3,tariffs=3,add_meter=5,add_tariff=2,set_tariff=2"
+
+
+# Заміна MongoDB та RabbitMQ для запуску без зовнішніх сервісів
+class LockedCollection:
+    """Колекція mongomock, до якої по черзі звертаються потоки обробника і цикл подій web_app."""
+
+    def __init__(self, collection, lock: threading.Lock):
+        self.collection = collection
+        self.lock = lock
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                result = attr(*args, **kwargs)
+                # Курсор mongomock читає колекцію ліниво, тож результат вичитується під локом
+                return list(result) if name in ("find", "aggregate") else result
+        return locked
+
+
+class LockedDatabase:
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.collections: dict[str, LockedCollection] = {}
+
+    def __getitem__(self, name: str) -> LockedCollection:
+        if name not in self.collections:
+            self.collections[name] = LockedCollection(self.db[name], self.lock)
+        return self.collections[name]
+
+
+class AsyncListCursor:
+    def __init__(self, docs: list):
+        self.docs = docs
+
+    async def to_list(self, length=None):
+        return self.docs if length is None else self.docs[:length]
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+    async def close(self):
+        pass
+
+
+class AsyncCollection:
+    """Асинхронний інтерфейс pymongo поверх LockedCollection для web_app."""
+
+    def __init__(self, collection: LockedCollection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs) -> AsyncListCursor:
+        return AsyncListCursor(self.collection.find(*args, **kwargs))
+
+    async def aggregate(self, *args, **kwargs) -> AsyncListCursor:
+        kwargs.pop("batchSize", None)
+        return AsyncListCursor(self.collection.aggregate(*args, **kwargs))
+
+    def __getattr__(self, name: str):
+        method = getattr(self.collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class AsyncDatabase:
+    def __init__(self, db: LockedDatabase):
+        self.db = db
+
+    def __getitem__(self, name: str) -> AsyncCollection:
+        return AsyncCollection(self.db[name])
+
+
+class FakeIncomingMessage:
+    def __init__(self, queue: "FakeQueue", message):
+        self.queue = queue
+        self.body = message.body
+        self.headers = message.headers or {}
+        self.correlation_id = message.correlation_id
+        self.reply_to = message.reply_to
+
+    async def ack(self):
+        pass
+
+    async def nack(self, requeue: bool = True):
+        if requeue:
+            self.queue.put(self)
+
+
+class FakeQueue:
+    """Черга з одним споживачем; prefetch обмежує кількість повідомлень в обробці, як basic_qos."""
+
+    def __init__(self, name: str, consumer, prefetch: int):
+        self.name = name
+        self.consumer = consumer
+        self.slots = asyncio.Semaphore(prefetch)
+        self.waiting = 0
+        self.tasks: set[asyncio.Task] = set()
+
+    def put(self, message: FakeIncomingMessage):
+        self.waiting += 1
+        task = asyncio.get_running_loop().create_task(self.__deliver(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def __deliver(self, message: FakeIncomingMessage):
+        async with self.slots:
+            self.waiting -= 1
+            await self.consumer(message)
+
+
+class FakeBroker:
+    """RabbitMQ у пам'яті: direct-exchange electrical_bills і default exchange для відповідей."""
+
+    def __init__(self):
+        self.queues: dict[str, FakeQueue] = {}
+        self.bindings: dict[str, list[str]] = {}
+
+    def declare(self, name: str, consumer, prefetch: int = 1_000_000, routing_keys: tuple[str, ...] = ()):
+        self.queues[name] = FakeQueue(name, consumer, prefetch)
+        for routing_key in routing_keys:
+            self.bindings.setdefault(routing_key, []).append(name)
+        return self.queues[name]
+
+    def exchange(self, name: str) -> "FakeExchange":
+        return FakeExchange(self, name)
+
+    def route(self, exchange: str, routing_key: str, message):
+        names = [routing_key] if exchange == "" else self.bindings.get(routing_key, [])
+        for name in names:
+            queue = self.queues.get(name)
+            if queue is not None:
+                queue.put(FakeIncomingMessage(queue, message))
+
+
+class FakeExchange:
+    def __init__(self, broker: FakeBroker, name: str):
+        self.broker = broker
+        self.name = name
+
+    async def publish(self, message, routing_key: str):
+        self.broker.route(self.name, routing_key, message)
+
+
+class FakeChannel:
+    is_closed = False
+
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+        self.default_exchange = broker.exchange("")
+
+    async def declare_queue(self, name: str, passive: bool = False):
+        queue = self.broker.queues[name]
+        return SimpleNamespace(name=name, declaration_result=SimpleNamespace(message_count=queue.waiting))
+
+
+class FakeConnection:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    async def channel(self) -> FakeChannel:
+        return FakeChannel(self.broker)
+
+
+def in_process_app(mongo: str | None, concurrency: int, prefetch: int):
+    """Налаштовує web_app і асинхронний обробник в одному процесі без lifespan.
+
+    Без mongo використовується mongomock, інакше — вказаний mongod.
+    """
+    import mongomock
+    from fastapi.templating import Jinja2Templates
+    from pymongo import AsyncMongoClient, MongoClient
+
+    import app
+    from async_handler import AsyncHandler
+    from electricall_bills import ElectricalBills
+    from electrical_bills_handler import EVENTS_ROUTING_KEY, shard_queue_name, shard_routing_key
+    from idempotency import IdempotencyStore
+
+    if mongo:
+        MongoClient(mongo).drop_database("electrical_bills_load")
+        handler_db = MongoClient(mongo, maxPoolSize=max(100, concurrency))["electrical_bills_load"]
+        app.db = AsyncMongoClient(mongo)["electrical_bills_load"]
+    else:
+        handler_db = LockedDatabase(mongomock.MongoClient()["electrical_bills_load"])
+        app.db = AsyncDatabase(handler_db)
+
+    bm, idempotency = ElectricalBills(handler_db), IdempotencyStore(handler_db)
+    bm.create_indexes()
+    idempotency.create_indexes()
+
+    broker = FakeBroker()
+    handler = AsyncHandler(bm, idempotency, FakeChannel(broker), broker.exchange("electrical_bills"), concurrency)
+    for shard in range(app.HANDLER_SHARDS):
+        broker.declare(shard_queue_name(shard, app.HANDLER_SHARDS), handler.on_message, prefetch,
+                       (shard_routing_key(shard, app.HANDLER_SHARDS),))
+    broker.declare("handler.events", handler.on_event, routing_keys=(EVENTS_ROUTING_KEY,))
+    broker.declare("web.events", app.on_event, routing_keys=(EVENTS_ROUTING_KEY,))
+    app.reply_queue = broker.declare("web.replies", app.on_reply)
+    app.exchange = broker.exchange("electrical_bills")
+    app.connection = FakeConnection(broker)
+    app.templates = Jinja2Templates(directory=TEMPLATES_DIR)
+    return app.app, handler
+
+
+class LoadGenerator:
+    """Надсилає запити до ендпоінтів web_app у заданій пропорції та збирає затримки і помилки."""
+
+    def __init__(self, client: httpx.AsyncClient, mix: dict[str, int], meters: int, seed: int = SEED):
+        self.client = client
+        self.mix = mix
+        self.meters = meters
+        self.rng = random.Random(seed)
+        self.last_readings = {meter_id: (0.0, 0.0) for meter_id in range(meters)}
+        self.next_meter_id = meters
+        self.tariff_ids: list[str] = []
+        self.samples: dict[str, list[tuple[float, str]]] = {operation: [] for operation in mix}
+
+    async def setup(self):
+        for meter_id in range(self.meters):
+            await self.post("/add_meter", {"meter_id": meter_id})
+        await self.post("/add_tariff", {"day_tariff": 1.5, "night_tariff": 0.75, "set_as_current": "true"})
+        await self.post("/add_tariff", {"day_tariff": 2.0, "night_tariff": 1.0, "set_as_current": "false"})
+        # Існуючі лічильники з попередніх запусків проти реального стеку
+        self.next_meter_id = self.meters + 1_000_000 * self.rng.randrange(1, 1000)
+        page = (await self.client.get("/tariffs")).text
+        self.tariff_ids = re.findall(r'data-tariff-id="([0-9a-f]{24})"', page)
+
+    async def post(self, path: str, data: dict) -> httpx.Response:
+        return await self.client.post(path, data=data, headers={"Accept": "application/json"})
+
+    def request(self, operation: str):
+        match operation:
+            case "add_reading":
+                meter_id = self.rng.randrange(self.meters)
+                day, night = self.last_readings[meter_id]
+                day, night = round(day + self.rng.uniform(1, 20), 2), round(night + self.rng.uniform(1, 10), 2)
+                self.last_readings[meter_id] = (day, night)
+                return self.post("/add_reading", {"meter_id": meter_id, "phase1": day, "phase2": night})
+            case "add_meter":
+                self.next_meter_id += 1
+                return self.post("/add_meter", {"meter_id": self.next_meter_id})
+            case "add_tariff":
+                return self.post("/add_tariff", {"day_tariff": round(self.rng.uniform(1, 3), 2),
+                                                 "night_tariff": round(self.rng.uniform(0.5, 1.5), 2),
+                                                 "set_as_current": "false"})
+            case "set_tariff":
+                return self.post("/set_tariff", {"tariff_id": self.rng.choice(self.tariff_ids)})
+            case "index":
+                if self.rng.random() < 0.5:
+                    return self.client.get("/", params={"meter_id": self.rng.randrange(self.meters)})
+                return self.client.get("/")
+            case "meters":
+                return self.client.get("/meters")
+            case "tariffs":
+                return self.client.get("/tariffs")
+        raise ValueError(f"Unknown operation {operation}")
+
+    async def call(self, operation: str):
+        started = time.perf_counter()
+        try:
+            response = await self.request(operation)
+        except httpx.HTTPError:
+            outcome = "transport_error"
+        else:
+            if response.status_code == 503:
+                outcome = "rejected"
+            elif response.status_code >= 400:
+                outcome = "http_error"
+            elif response.headers.get("content-type", "").startswith("application/json") and \
+                    response.json().get("response"):
+                # Запит дійшов до обробника, але той повернув помилку (напр. накручені покази)
+                outcome = "app_error"
+            else:
+                outcome = "ok"
+        self.samples[operation].append(((time.perf_counter() - started) * 1000, outcome))
+
+    async def run(self, concurrency: int, duration: float, requests: int) -> float:
+        operations, weights = list(self.mix), list(self.mix.values())
+        deadline = time.perf_counter() + duration if duration else None
+        remaining = [requests]
+
+        async def worker():
+            while (deadline is None or time.perf_counter() < deadline) and (not requests or remaining[0] > 0):
+                remaining[0] -= 1
+                await self.call(self.rng.choices(operations, weights)[0])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float) -> list[dict]:
+        results = []
+        everything = [sample for samples in self.samples.values() for sample in samples]
+        for name, samples in (*self.samples.items(), ("total", everything)):
+            if not samples:
+                continue
+            latencies = sorted(latency for latency, _ in samples)
+            outcomes = {}
+            for _, outcome in samples:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            results.append({
+                "operation": name,
+                "requests": len(samples),
+                "rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+                "p50_ms": round(percentile(latencies, 50), 3),
+                "p95_ms": round(percentile(latencies, 95), 3),
+                "p99_ms": round(percentile(latencies, 99), 3),
+                "max_ms": round(latencies[-1], 3),
+                "error_rate": round(1 - outcomes.get("ok", 0) / len(samples), 4),
+                "outcomes": outcomes,
+            })
+        return results
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = int(weight or 1)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+async def main_async(args):
+    handler = None
+    if args.url:
+        transport = None
+        base_url = args.url
+    else:
+        asgi_app, handler = in_process_app(args.mongo, args.handler_concurrency, args.prefetch)
+        transport = httpx.ASGITransport(app=asgi_app)
+        base_url = "http://loadgen"
+
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+            generator = LoadGenerator(client, parse_mix(args.mix), args.meters)
+            await generator.setup()
+            elapsed = await generator.run(args.concurrency, args.duration, args.requests)
+            return generator.report(elapsed)
+    finally:
+        if handler is not None:
+            handler.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Генератор навантаження на ендпоінти web_app")
+    parser.add_argument("--url", default=None,
+                        help="адреса запущеного web_app, напр. http://localhost:8000; без неї web_app і "
+                             "асинхронний обробник запускаються в цьому процесі з RabbitMQ у пам'яті")
+    parser.add_argument("--mongo", default=None,
+                        help="URI mongod для запуску в процесі; без нього використовується mongomock")
+    parser.add_argument("--concurrency", type=int, default=20, help="кількість одночасних клієнтів")
+    parser.add_argument("--duration", type=float, default=10, help="тривалість у секундах; 0 — до --requests")
+    parser.add_argument("--requests", type=int, default=0, help="загальна кількість запитів; 0 — без обмеження")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"ваги операцій (за замовчуванням {DEFAULT_MIX})")
+    parser.add_argument("--meters", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=30, help="таймаут HTTP-запиту, с")
+    parser.add_argument("--handler-concurrency", type=int, default=8, help="для запуску в процесі")
+    parser.add_argument("--prefetch", type=int, default=16, help="для запуску в процесі")
+    parser.add_argument("--output", default=None, help="файл для збереження результатів у JSON")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    for name in mix:
+        if name not in ("add_reading", "add_meter", "add_tariff", "set_tariff", "index", "meters", "tariffs"):
+            parser.error(f"unknown operation {name}")
+    if not args.duration and not args.requests:
+        parser.error("either --duration or --requests is required")
+
+    results = asyncio.run(main_async(args))
+    for result in results:
+        print(f"{result['operation']:<12} {result['requests']:>7} req {result['rps']:>9} req/s  "
+              f"p50 {result['p50_ms']:.2f}ms  p95 {result['p95_ms']:.2f}ms  p99 {result['p99_ms']:.2f}ms  "
+              f"errors {result['error_rate']:.2%}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "commit": git_commit(),
+                "date_time": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "target": args.url or ("in-process+mongod" if args.mongo else "in-process+mongomock"),
+                "params": {"concurrency": args.concurrency, "duration": args.duration, "requests": args.requests,
+                           "mix": mix, "meters": args.meters, "seed": SEED},
+                "results": results,
+            }, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
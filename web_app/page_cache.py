@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable, Iterable
+from typing import Any
+
+
+class PageCache:
+    """LRU-кеш з TTL, записи якого позначені тегами для точкової інвалідації."""
+
+    def __init__(self, max_size: int = 1000, ttl: float = 30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__entries: OrderedDict[Hashable, tuple[float, frozenset[str], Any]] = OrderedDict()
+        self.__tags: dict[str, set[Hashable]] = {}
+        # Лічильники інвалідацій тегів і очищень кешу, щоб не кешувати результат, завантажений до події
+        self.__generations: dict[str, int] = {}
+        self.__clears = 0
+
+    def get(self, key: Hashable, default=None):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] < time.monotonic():
+            self.__remove(key)
+            return default
+        self.__entries.move_to_end(key)
+        return entry[2]
+
+    def set(self, key: Hashable, value, tags: Iterable[str] = ()):
+        if key in self.__entries:
+            self.__remove(key)
+
+        tags = frozenset(tags)
+        self.__entries[key] = (time.monotonic() + self.ttl, tags, value)
+        for tag in tags:
+            self.__tags.setdefault(tag, set()).add(key)
+
+        while len(self.__entries) > self.max_size:
+            self.__remove(next(iter(self.__entries)))
+
+    async def get_or_load(self, key: Hashable, tags: Iterable[str], loader: Callable[[], Awaitable[Any]]):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            tags = frozenset(tags)
+            generation = self.__generation(tags)
+            value = await loader()
+            # Подія під час завантаження могла зробити результат застарілим: віддаємо його, але не кешуємо
+            if self.__generation(tags) == generation:
+                self.set(key, value, tags)
+        return value
+
+    def invalidate(self, *tags: str):
+        for tag in tags:
+            self.__generations[tag] = self.__generations.get(tag, 0) + 1
+            for key in list(self.__tags.get(tag, ())):
+                self.__remove(key)
+
+    def clear(self):
+        self.__clears += 1
+        self.__entries.clear()
+        self.__tags.clear()
+
+    def __generation(self, tags: frozenset[str]) -> tuple:
+        return self.__clears, tuple(self.__generations.get(tag, 0) for tag in sorted(tags))
+
+    def __remove(self, key: Hashable):
+        _, tags, _ = self.__entries.pop(key)
+        for tag in tags:
+            keys = self.__tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__tags[tag]
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+_MISSING = object()
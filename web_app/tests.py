@@ -0,0 +1,293 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from mongomock import MongoClient
+
+import app
+from page_cache import PageCache
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "electrical_bills"))
+from electricall_bills import ElectricalBills  # noqa: E402
+import electrical_bills_handler as handler  # noqa: E402
+from retention import RetentionJob  # noqa: E402
+
+
+class FakeCursor:
+    """Асинхронний курсор поверх курсора mongomock."""
+
+    def __init__(self, docs):
+        self.docs = iter(docs)
+
+    async def to_list(self):
+        return list(self.docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.docs)
+        except StopIteration:
+            raise StopAsyncIteration from None
+
+    async def close(self):
+        pass
+
+
+class FakeCollection:
+    """Асинхронна колекція поверх колекції mongomock з методами, якими користується web_app."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return FakeCursor(self.collection.find(*args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+    async def aggregate(self, pipeline, **kwargs):
+        return FakeCursor(self.collection.aggregate(pipeline))
+
+
+class FakeExchange:
+    """Exchange, що запам'ятовує опубліковані повідомлення й відповідає на них через reply."""
+
+    def __init__(self, reply=None):
+        self.published = []
+        self.reply = reply
+
+    async def publish(self, message, routing_key: str):
+        self.published.append((message, routing_key))
+        if self.reply:
+            asyncio.get_running_loop().call_soon(self.reply, message)
+
+
+class FakeReply:
+    def __init__(self, correlation_id: str, body: dict):
+        self.correlation_id = correlation_id
+        self.body = json.dumps(body).encode()
+
+
+class TestPageCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = PageCache(max_size=2, ttl=30)
+
+    def test_hit(self):
+        """Збережене значення повертається без повторного завантаження"""
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            return "page"
+
+        self.assertEqual(asyncio.run(self.cache.get_or_load("key", ["tag"], loader)), "page")
+        self.assertEqual(asyncio.run(self.cache.get_or_load("key", ["tag"], loader)), "page")
+        self.assertEqual(len(loads), 1)
+
+    def test_ttl_expiry(self):
+        """Запис після TTL вважається відсутнім"""
+        with mock.patch("page_cache.time.monotonic", return_value=100.0):
+            self.cache.set("key", "page")
+        with mock.patch("page_cache.time.monotonic", return_value=129.0):
+            self.assertEqual(self.cache.get("key"), "page")
+        with mock.patch("page_cache.time.monotonic", return_value=131.0):
+            self.assertIsNone(self.cache.get("key"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        """При переповненні витісняється найдавніше використаний запис"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertEqual((self.cache.get("a"), self.cache.get("b"), self.cache.get("c")), (1, None, 3))
+
+    def test_tag_invalidation(self):
+        """Інвалідація тегу видаляє лише позначені ним записи"""
+        self.cache.set("a", 1, ["readings:1"])
+        self.cache.set("b", 2, ["readings:2"])
+        self.cache.invalidate("readings:1")
+
+        self.assertEqual((self.cache.get("a"), self.cache.get("b")), (None, 2))
+
+    def test_invalidate_during_load(self):
+        """Результат, завантажений до події, віддається, але не кешується"""
+        async def load():
+            async def loader():
+                self.cache.invalidate("readings:1")
+                return "stale"
+
+            return await self.cache.get_or_load("key", ["readings:1"], loader)
+
+        self.assertEqual(asyncio.run(load()), "stale")
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_clear_during_load(self):
+        """Очищення кешу під час завантаження теж не дає закешувати результат"""
+        async def loader():
+            self.cache.clear()
+            return "stale"
+
+        asyncio.run(self.cache.get_or_load("key", ["tariff"], loader))
+        self.assertIsNone(self.cache.get("key"))
+
+
+class TestRpc(unittest.TestCase):
+    def setUp(self):
+        self.exchange = FakeExchange()
+        for name, value in (("exchange", self.exchange), ("reply_queue", mock.Mock(name="replies")),
+                            ("rpc_slots", asyncio.Semaphore(2)), ("UPDATES_QUEUE_MAX_DEPTH", 10),
+                            ("RPC_TIMEOUT", 0.05), ("RPC_RETRIES", 1)):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.depth = mock.patch.object(app, "updates_queue_depth", mock.AsyncMock(return_value=0))
+        self.depth.start()
+        self.addCleanup(self.depth.stop)
+        self.addCleanup(app.pending_replies.clear)
+
+    def reply_with(self, *bodies):
+        """Обробник, що відповідає на кожне повідомлення спершу чужим correlation_id, потім своїм."""
+        def reply(message):
+            asyncio.get_running_loop().create_task(app.on_reply(FakeReply("someone-else", {"response": "чужа"})))
+            for body in bodies:
+                asyncio.get_running_loop().create_task(app.on_reply(FakeReply(message.correlation_id, body)))
+        self.exchange.reply = reply
+
+    def test_reply_correlation(self):
+        """Відповідь зіставляється з запитом за correlation_id, чужі відповіді ігноруються"""
+        self.reply_with({"response": None}, {"response": "повтор"})
+
+        response = asyncio.run(app.send_request_and_get_response({"meter_id": 1, "day": 1.0, "night": 1.0}))
+        self.assertEqual(response, {"response": None})
+        self.assertEqual(len(self.exchange.published), 1)
+        self.assertEqual(app.pending_replies, {})
+
+    def test_late_reply_ignored(self):
+        """Відповідь після таймауту не ламає наступні запити"""
+        response = asyncio.run(app.send_request_and_get_response({"meter_id": 1, "day": 1.0, "night": 1.0}))
+        self.assertEqual(response["response"], "Сервер не відповів вчасно. Спробуйте пізніше.")
+
+        late = FakeReply(self.exchange.published[-1][0].correlation_id, {"response": None})
+        asyncio.run(app.on_reply(late))
+        self.assertEqual(app.pending_replies, {})
+
+    def test_timeout_retries_with_same_idempotency_key(self):
+        """Повтор після таймауту несе той самий ключ ідемпотентності та власний дедлайн"""
+        started = time.time()
+        asyncio.run(app.send_request_and_get_response({"meter_id": 3, "day": 1.0, "night": 1.0}))
+
+        self.assertEqual(len(self.exchange.published), app.RPC_RETRIES + 1)
+        keys = {json.loads(message.body)["data"]["idempotency_key"] for message, _ in self.exchange.published}
+        self.assertEqual(len(keys), 1)
+        correlation_ids = {message.correlation_id for message, _ in self.exchange.published}
+        self.assertEqual(len(correlation_ids), 2)
+        for message, routing_key in self.exchange.published:
+            self.assertEqual(routing_key, "electrical.bills.updates")
+            self.assertEqual(message.expiration, app.RPC_TIMEOUT)
+            self.assertAlmostEqual(message.headers["x-deadline"] - message.headers["x-published-at"], app.RPC_TIMEOUT,
+                                   places=3)
+            self.assertGreaterEqual(message.headers["x-published-at"], started)
+
+    def test_deadline_expiry(self):
+        """Обробник відкидає повідомлення, дедлайн якого минув, поки воно чекало в черзі"""
+        asyncio.run(app.send_request_and_get_response({"meter_id": 1, "day": 1.0, "night": 1.0}))
+        headers = self.exchange.published[0][0].headers
+
+        with mock.patch("electrical_bills_handler.time.time", return_value=headers["x-deadline"] - 1):
+            self.assertFalse(handler.deadline_expired(mock.Mock(headers=headers)))
+        with mock.patch("electrical_bills_handler.time.time", return_value=headers["x-deadline"] + 1):
+            self.assertTrue(handler.deadline_expired(mock.Mock(headers=headers)))
+
+    def test_saturation_rejected(self):
+        """Запит відхиляється одразу, коли всі слоти RPC зайняті"""
+        async def saturated():
+            async with app.rpc_slots, app.rpc_slots:
+                with self.assertRaises(app.HandlerOverloaded):
+                    await app.send_request_and_get_response({"meter_id": 1, "day": 1.0, "night": 1.0})
+
+        asyncio.run(saturated())
+        self.assertEqual(self.exchange.published, [])
+
+    def test_queue_depth_rejected(self):
+        """Переповнена черга оновлень відхиляє запити, окрім тих, що чекають на слот"""
+        self.reply_with({"response": None})
+        app.updates_queue_depth.return_value = app.UPDATES_QUEUE_MAX_DEPTH
+        data = {"meter_id": 1, "day": 1.0, "night": 1.0}
+
+        with self.assertRaises(app.HandlerOverloaded):
+            asyncio.run(app.send_request_and_get_response(dict(data)))
+        self.assertEqual(asyncio.run(app.send_request_and_get_response(dict(data), fail_fast=False)),
+                         {"response": None})
+        self.assertEqual(len(self.exchange.published), 1)
+
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self.db = MongoClient()["test_db"]
+        self.eb = ElectricalBills(self.db)
+        self.eb.create_indexes()
+        self.eb.add_tariff(1.0, 0.5, set_as_current=True)
+        self.eb.add_meter(1)
+        # П'ять показів переносяться в архів двома бакетами, ще три лишаються в meters_data
+        start = datetime.now() - timedelta(days=60)
+        for i in range(8):
+            with mock.patch("electricall_bills.datetime") as clock:
+                clock.now.return_value = start + timedelta(days=i * 7)
+                self.eb.add_meter_data(1, 10.0 * (i + 1), 5.0 * (i + 1))
+        RetentionJob(self.eb, start + timedelta(days=30)).run()
+        self.assertEqual((self.db["meters_data"].count_documents({}), self.db["meters_archive"].count_documents({})),
+                         (3, 2))
+        # По одному бакету на aggregate, щоб було видно, скільки бакетів розгортає сторінка
+        patcher = mock.patch.object(app, "ARCHIVE_PAGE_BUCKETS", 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, after=None, before=None, limit=2):
+        return asyncio.run(app.fetch_page(FakeCollection(self.db["meters_data"]), {"meter_id": 1},
+                                          app.METERS_DATA_PROJECTION, after, before, limit,
+                                          archive=FakeCollection(self.db["meters_archive"])))
+
+    def test_pages_forward_and_back_across_tiers(self):
+        """Сторінки йдуть від новіших показів до старіших через межу meters_data і архіву й назад"""
+        pages, after = [], None
+        while True:
+            docs, prev_cursor, next_cursor = self.fetch(after=after)
+            pages.append(([doc["day"] for doc in docs], prev_cursor))
+            if not next_cursor:
+                break
+            after = next_cursor
+        self.assertEqual([days for days, _ in pages], [[80.0, 70.0], [60.0, 50.0], [40.0, 30.0], [20.0, 10.0]])
+        self.assertIsNone(pages[0][1])
+
+        # Назад від останньої сторінки тими самими межами
+        before = pages[-1][1]
+        for days, _ in reversed(pages[:-1]):
+            docs, prev_cursor, next_cursor = self.fetch(before=before)
+            self.assertEqual([doc["day"] for doc in docs], days)
+            self.assertIsNotNone(next_cursor)
+            before = prev_cursor
+        self.assertIsNone(before)
+
+    def test_archive_page_stops_after_full_page(self):
+        """Сторінка повністю з архіву не розгортає бакети, старші за її останній показ"""
+        docs, _, _ = self.fetch(limit=8)
+        after = app.encode_cursor(docs[2])
+        archive = FakeCollection(self.db["meters_archive"])
+        with mock.patch.object(archive, "aggregate", wraps=archive.aggregate) as aggregate:
+            docs, _, _ = asyncio.run(app.fetch_page(FakeCollection(self.db["meters_data"]), {"meter_id": 1},
+                                                    app.METERS_DATA_PROJECTION, after, None, 1, archive=archive))
+        self.assertEqual([doc["day"] for doc in docs], [50.0])
+        self.assertEqual(aggregate.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()